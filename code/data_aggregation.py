@@ -0,0 +1,242 @@
+## code to count records for every pair of categorical columns up front, so grouped counts can be sliced out rather than recomputed from the data
+
+import math
+import numpy as np
+import pandas as pd
+from data_types import iter_refined, read_refined
+
+class ContingencyCube:
+    """
+    This class holds the number of records taking each pair of values, for every pair of categorical columns. Records can
+    be weighted, and counts scaled, to estimate the population a sample represents.
+    """
+    def __init__(self, columns, pairs = True, weighted = False, scale = 1):
+        """
+        Constructor for ContingencyCube. Counts start at zero, and are added to by update.
+
+        Parameters:
+        - columns (List[str]): categorical columns to count.
+        - pairs (bool): if False, only count values of each column on its own, for frequencies but not tables.
+        - weighted (bool): if True, sum the weight of each record given to update rather than counting records.
+        - scale (int, float): number each count is multiplied by on the way out, e.g. 100 for a 1% sample.
+        """
+        self.columns = list(columns)
+        self.categories = {col: [] for col in self.columns}
+        self.weighted = weighted
+        self.scale = scale
+        # Counts stored once for each pair, in the order columns are given. Reverse pairs are transposed on the way out
+        self.counts = {}
+        for i, col1 in enumerate(self.columns):
+            for col2 in (self.columns[i:] if pairs else [col1]):
+                self.counts[(col1, col2)] = np.zeros((0, 0), dtype = np.float64 if weighted else np.uint32)
+        self.n_records = 0
+        self.weight_total = 0.0
+
+    def _grow(self, col):
+        """
+        Adds zero counts for categories newly added to a column.
+
+        Parameters:
+        - col (str): column with new categories.
+        """
+        n = len(self.categories[col])
+        for (col1, col2), arr in self.counts.items():
+            pad = [(0, n - arr.shape[0] if col1 == col else 0), (0, n - arr.shape[1] if col2 == col else 0)]
+            self.counts[(col1, col2)] = np.pad(arr, pad)
+
+    def _codes(self, data):
+        """
+        Gets the codes of a categorical column in terms of this cube's categories, adding any it has not seen.
+
+        Parameters:
+        - data (pd.Series): categorical column.
+
+        Returns:
+        np.ndarray: code of each value, -1 if missing.
+        """
+        cats = self.categories[data.name]
+        new = [x for x in data.cat.categories if x not in cats]
+        if len(new) > 0:
+            cats.extend(new)
+            self._grow(data.name)
+        # Last entry maps the missing value code (-1) to itself
+        lookup = np.array([cats.index(x) for x in data.cat.categories] + [-1])
+        return lookup[data.cat.codes.to_numpy()]
+
+    def _distinct_rows(self, df, weights = None):
+        """
+        Counts how many times each distinct combination of values occurs, so pairs are counted over these rather than every record.
+
+        Parameters:
+        - df (pd.DataFrame): data containing all columns of the cube.
+        - weights (np.ndarray): weight of each record, if weighted.
+
+        Returns:
+        dict: code of each column for each combination.
+        np.ndarray: number of records with each combination.
+        np.ndarray: total weight of records with each combination, the number of records if not weighted.
+        """
+        codes = {col: self._codes(df[col]) for col in self.columns}
+        # Records with missing values can't be placed in any cell
+        valid = np.logical_and.reduce([x >= 0 for x in codes.values()])
+        sizes = [len(self.categories[col]) for col in self.columns]
+        # Combine codes into a single integer key if it can't overflow, else let pandas group the columns
+        if math.prod(sizes) < 2 ** 63:
+            key = np.zeros(valid.sum(), dtype = np.int64)
+            for col, n in zip(self.columns, sizes):
+                key *= n
+                key += codes[col][valid]
+            if weights is None:
+                key_counts = pd.Series(key).value_counts(sort = False)
+                keys, counts, totals = key_counts.index.to_numpy(), key_counts.to_numpy(), key_counts.to_numpy()
+            else:
+                grouped = pd.Series(weights[valid]).groupby(key, sort = False).agg(['size', 'sum'])
+                keys, counts, totals = grouped.index.to_numpy(), grouped['size'].to_numpy(), grouped['sum'].to_numpy()
+            for col, n in zip(reversed(self.columns), reversed(sizes)):
+                keys, codes[col] = np.divmod(keys, n)
+            return codes, counts, totals
+        frame = pd.DataFrame({col: codes[col][valid] for col in self.columns})
+        frame['_weight'] = weights[valid] if weights is not None else 1
+        grouped = frame.groupby(self.columns, sort = False)['_weight'].agg(['size', 'sum'])
+        codes = {col: grouped.index.get_level_values(col).to_numpy() for col in self.columns}
+        return codes, grouped['size'].to_numpy(), grouped['sum'].to_numpy()
+
+    def update(self, df, weights = None):
+        """
+        Adds the records in df to the counts.
+
+        Parameters:
+        - df (pd.DataFrame): data containing all columns of the cube, as categoricals.
+        - weights (pd.Series, np.ndarray): weight of each record, only used if the cube is weighted.
+        """
+        if not self.weighted:
+            weights = None
+        elif weights is not None:
+            weights = np.asarray(weights, dtype = np.float64)
+        codes, counts, totals = self._distinct_rows(df, weights)
+        for (col1, col2), arr in self.counts.items():
+            n1, n2 = arr.shape
+            flat = np.bincount(codes[col1] * n2 + codes[col2], weights = totals, minlength = n1 * n2)
+            arr += flat.reshape(n1, n2).astype(arr.dtype)
+        self.n_records += int(counts.sum())
+        self.weight_total += float(totals.sum())
+
+    def _scaled(self, arr):
+        """
+        Converts stored counts to the counts given out, applying the scale.
+
+        Parameters:
+        - arr (np.ndarray): stored counts.
+
+        Returns:
+        np.ndarray: counts, as int64 if not weighted and scale is a whole number.
+        """
+        return (arr if self.weighted else arr.astype(np.int64)) * self.scale
+
+    def total(self):
+        """
+        Gets the total of all counts, the number of records if not weighted or scaled. Kept as records are added, so charts don't sum counts again.
+
+        Returns:
+        int, float: total weighted and scaled count.
+        """
+        return (self.weight_total if self.weighted else self.n_records) * self.scale
+
+    def sort_categories(self, col):
+        """
+        Sorts the categories of a column by value, as pandas orders the categories of an unordered categorical. Categories
+        are otherwise in the order first seen, which can differ when data is counted a chunk at a time.
+
+        Parameters:
+        - col (str): column to sort categories of.
+        """
+        cats = self.categories[col]
+        order = sorted(range(len(cats)), key = lambda i: cats[i])
+        self.categories[col] = [cats[i] for i in order]
+        for (col1, col2), arr in self.counts.items():
+            if col1 == col:
+                arr = arr[order, :]
+            if col2 == col:
+                arr = arr[:, order]
+            self.counts[(col1, col2)] = arr
+
+    def table(self, col1, col2):
+        """
+        Gets the number of records taking each pair of values of two columns, including pairs with no records.
+
+        Parameters:
+        - col1 (str): column giving rows of table.
+        - col2 (str): column giving columns of table.
+
+        Returns:
+        pd.DataFrame: number of records, indexed by values of col1, with columns the values of col2.
+        """
+        if (col1, col2) in self.counts:
+            arr = self.counts[(col1, col2)]
+        else:
+            arr = self.counts[(col2, col1)].T
+        index = pd.Index(self.categories[col1], name = col1)
+        columns = pd.Index(self.categories[col2], name = col2)
+        return pd.DataFrame(self._scaled(arr), index = index, columns = columns)
+
+    def frequencies(self, col):
+        """
+        Gets the number of records taking each value of a column, including values with no records.
+
+        Parameters:
+        - col (str): column to count values of.
+
+        Returns:
+        pd.Series: number of records, indexed by values of col.
+        """
+        arr = self._scaled(np.diag(self.counts[(col, col)]))
+        return pd.Series(arr, index = pd.Index(self.categories[col], name = col), name = 'count')
+
+def count_refined(filepath, chunksize, pairs = True, weight = None, scale = 1):
+    """
+    Counts the categorical columns of refined data a chunk at a time, so files larger than memory can be described. Chunks are
+    dropped once counted, so the data itself is never kept.
+
+    Parameters:
+    - filepath (str): filepath where refined data is found, in any of OUTPUT_FORMATS.
+    - chunksize (int): number of rows to read at a time.
+    - pairs (bool): if False, only count values of each column on its own.
+    - weight (str): column giving the weight of each record, if records are weighted.
+    - scale (int, float): number each count is multiplied by.
+
+    Returns:
+    ContingencyCube: counts of the categorical columns.
+    pd.Series: data type of each column.
+    """
+    cube = None
+    for chunk in iter_refined(filepath, chunksize):
+        if cube is None:
+            dtypes = chunk.dtypes
+            cube = ContingencyCube(chunk.select_dtypes('category').columns, pairs = pairs, weighted = weight != None, scale = scale)
+        cube.update(chunk, chunk[weight] if weight != None else None)
+    # Unordered categories, such as Region, are found chunk by chunk, so put them in the order reading the whole file gives
+    for col in cube.columns:
+        if not dtypes[col].ordered:
+            cube.sort_categories(col)
+    return cube, dtypes
+
+def build_cube(filepath, chunksize = None, weight = None, scale = 1):
+    """
+    Reads refined data and counts every pair of categorical columns. Charts are drawn from these counts, so the data is only read once.
+
+    Parameters:
+    - filepath (str): filepath where refined data is found, in any of OUTPUT_FORMATS.
+    - chunksize (int): if given, read the data in chunks of this many rows, for files larger than memory.
+    - weight (str): column giving the weight of each record, if records are weighted.
+    - scale (int, float): number counts are multiplied by to estimate the population.
+
+    Returns:
+    ContingencyCube: counts of every pair of categorical columns.
+    pd.Series: data type of each column.
+    """
+    if chunksize is not None:
+        return count_refined(filepath, chunksize, weight = weight, scale = scale)
+    df = read_refined(filepath)
+    cube = ContingencyCube(df.select_dtypes('category').columns, weighted = weight != None, scale = scale)
+    cube.update(df, df[weight] if weight != None else None)
+    return cube, df.dtypes
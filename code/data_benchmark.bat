@@ -0,0 +1 @@
+python .\code\data_benchmark.py --scales 1 10 100 1000
\ No newline at end of file
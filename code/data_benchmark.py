@@ -0,0 +1,308 @@
+## code to benchmark the slow steps of refinement, aggregation and plotting on synthetic census shaped data. Can be called from terminal, see data_benchmark.bat
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import matplotlib
+# Render off screen, charts are only timed
+matplotlib.use('Agg')
+from data_types import REFINEMENT_SCHEMA, OUTPUT_FORMATS, read_refined
+from data_refinement import DataLoader
+from data_description import DataDescriber
+from data_plotting import DataPlotter
+
+# Number of rows in 'Scotland_teaching_file_1PCT.csv', the 1x scale
+BASE_ROWS = 63388
+
+# Largest data loaded whole into memory, about 1 GB of raw object columns. Larger scales only benchmark the chunked route
+MAX_IN_MEMORY_ROWS = 10 * BASE_ROWS
+# Rows read at a time by the chunked route
+CHUNKSIZE = 100000
+
+# Modules that load, refine and count data, and the chart drawing modules they must only import when a chart is drawn
+CORE_MODULES = ['data_types', 'data_aggregation', 'data_refinement', 'data_description', 'data_plotting', 'data_service']
+PLOTTING_MODULES = ['matplotlib', 'seaborn', 'ipywidgets', 'IPython']
+
+def generate_data(filepath, scale, invalid_fraction = 0.01, seed = 0):
+    """
+    Writes a synthetic census shaped .csv, with values drawn from REFINEMENT_SCHEMA. Written in blocks of BASE_ROWS rows, so memory stays bounded at any scale.
+
+    Parameters:
+    - filepath (str): filepath to write .csv to.
+    - scale (int): size of data as a multiple of BASE_ROWS.
+    - invalid_fraction (float): fraction of rows given an invalid value in one random column.
+    - seed (int): seed of random number generator, so data is the same between runs.
+    """
+    rng = np.random.default_rng(seed)
+    for block in range(scale):
+        df = pd.DataFrame(index = range(BASE_ROWS))
+        for col, checker, kwargs in REFINEMENT_SCHEMA:
+            if col == 'Record_Number':
+                df[col] = np.arange(block * BASE_ROWS + 1, (block + 1) * BASE_ROWS + 1).astype(str)
+            elif checker == 'string':
+                df[col] = rng.choice(['S92000003', 'S12000033', 'S12000034'], BASE_ROWS)
+            elif checker == 'known_values':
+                df[col] = rng.choice(kwargs['vals'], BASE_ROWS)
+            else:
+                vals = [str(x) for x in range(kwargs['min'], kwargs['max'] + 1)]
+                if kwargs.get('include_x') == True:
+                    vals.append('X')
+                df[col] = rng.choice(vals, BASE_ROWS)
+        # Give a random column of some rows a value no checker accepts
+        invalid = rng.random(BASE_ROWS) < invalid_fraction
+        target = rng.integers(0, len(df.columns), BASE_ROWS)
+        for i, col in enumerate(df.columns):
+            df.loc[invalid & (target == i), col] = '?'
+        df.to_csv(filepath, mode = 'w' if block == 0 else 'a', header = block == 0, index = False)
+
+def measure(setup, run, repeat):
+    """
+    Times a stage, then runs it once more while tracing memory allocations. Setup is not timed.
+
+    Parameters:
+    - setup (function): function returning the object to run the stage on, called before every run.
+    - run (function): function running the stage on the object returned by setup.
+    - repeat (int): number of timed runs.
+
+    Returns:
+    dict: fastest and mean time in seconds, and peak memory allocated by the stage in MB.
+    """
+    times = []
+    # Hide output printed by the classes, such as refinement reports and displayed images
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            obj = setup()
+            start = time.perf_counter()
+            run(obj)
+            times.append(time.perf_counter() - start)
+        obj = setup()
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        run(obj)
+        peak = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+    return {'seconds': min(times), 'mean_seconds': sum(times) / len(times), 'peak_mb': peak / 2 ** 20}
+
+def refined_loader(filepath):
+    """
+    Loads and refines a file, ready for drop_duplicates.
+    """
+    dl = DataLoader(filepath)
+    dl._rename_cols()
+    dl.refine_data()
+    return dl
+
+def benchmark_scale(workdir, scale, invalid_fraction, repeat, max_in_memory_rows = MAX_IN_MEMORY_ROWS):
+    """
+    Generates data at one scale and benchmarks each stage on it. Stages loading the whole file into memory are skipped above
+    max_in_memory_rows, as running out of memory kills the process rather than raising an error, losing every result.
+
+    Parameters:
+    - workdir (str): folder to write synthetic data to.
+    - scale (int): size of data as a multiple of BASE_ROWS.
+    - invalid_fraction (float): fraction of rows given an invalid value.
+    - repeat (int): number of timed runs of each stage.
+    - max_in_memory_rows (int): largest number of rows to benchmark loading whole into memory.
+
+    Returns:
+    list: dict of results for each stage.
+    """
+    raw_path = os.path.join(workdir, f'synthetic_{scale}x.csv')
+    refined_path = raw_path[:-4] + '_refined.csv'
+    chunked_path = raw_path[:-4] + '_refined_chunked.csv'
+    generate_data(raw_path, scale, invalid_fraction)
+    in_memory = scale * BASE_ROWS <= max_in_memory_rows
+    chunksize = None if in_memory else CHUNKSIZE
+    with contextlib.redirect_stdout(io.StringIO()):
+        if in_memory:
+            refined_loader(raw_path).save(refined_path)
+        else:
+            DataLoader(raw_path, chunksize = CHUNKSIZE).refine_file(refined_path)
+        dd = DataDescriber(refined_path, chunksize = chunksize)
+        dp = DataPlotter(refined_path, chunksize = chunksize)
+
+    def cleared(obj):
+        # Clear cached results, so each run does the work again
+        obj.cache.clear()
+        return obj
+
+    stages = {}
+    if in_memory:
+        stages.update({
+            'read_csv': (lambda: raw_path, DataLoader),
+            'refine_data': (lambda: DataLoader(raw_path), lambda dl: (dl._rename_cols(), dl.refine_data())),
+            'refine_data_parallel': (lambda: DataLoader(raw_path, check_workers = os.cpu_count()), lambda dl: (dl._rename_cols(), dl.refine_data())),
+            'drop_duplicates': (lambda: refined_loader(raw_path), lambda dl: dl.drop_duplicates()),
+        })
+    stages.update({
+        'refine_file': (lambda: DataLoader(raw_path, chunksize = CHUNKSIZE), lambda dl: dl.refine_file(chunked_path)),
+        'describer_load': (lambda: refined_path, lambda path: DataDescriber(path, chunksize = chunksize)),
+        '_grouped_no_records': (lambda: cleared(dd), lambda dd: dd._grouped_no_records('Age', 'Health')),
+        'unique_values': (lambda: dd, lambda dd: dd.unique_values()),
+        '_plot_bar_chart': (lambda: cleared(dp), lambda dp: dp._plot_bar_chart('Age')),
+    })
+    results = []
+    for stage, (setup, run) in stages.items():
+        result = {'scale': scale, 'rows': scale * BASE_ROWS, 'stage': stage, 'in_memory': in_memory}
+        try:
+            result.update(measure(setup, run, repeat))
+        except Exception as e:
+            # Record the failure rather than losing the other stages
+            result['error'] = f'{type(e).__name__}: {e}'
+        results.append(result)
+        print(f'{scale:>5}x  {stage:<20}  ' + (f'{result["seconds"]:>9.3f}s  {result["peak_mb"]:>9.1f} MB' if 'error' not in result else result['error']))
+    return results
+
+def import_cost(module, repeat):
+    """
+    Times importing a module in a fresh interpreter, and lists the chart drawing modules it imported.
+
+    Parameters:
+    - module (str): name of module in this folder to import.
+    - repeat (int): number of timed imports, fastest is reported.
+
+    Returns:
+    dict: fastest time in seconds, and chart drawing modules imported.
+    """
+    code = (f'import json, sys, time\nstart = time.perf_counter()\nimport {module}\nseconds = time.perf_counter() - start\n'
+            f'print(json.dumps({{"seconds": seconds, "plotting_modules": [x for x in {PLOTTING_MODULES} if x in sys.modules]}}))')
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd = os.path.dirname(os.path.abspath(__file__)), capture_output = True, text = True, check = True).stdout
+        runs.append(json.loads(out))
+    return {'module': module, 'seconds': min(x['seconds'] for x in runs), 'plotting_modules': runs[0]['plotting_modules']}
+
+def check_imports(repeat):
+    """
+    Times importing each module of CORE_MODULES, and checks none import chart drawing modules.
+
+    Parameters:
+    - repeat (int): number of timed imports of each module.
+
+    Returns:
+    list: dict of results for each module.
+    bool: True if no module imported chart drawing modules.
+    """
+    results = [import_cost(x, repeat) for x in CORE_MODULES]
+    for x in results:
+        print(f'import {x["module"]:<20}  {x["seconds"]:>9.3f}s  ' + (f'imports {", ".join(x["plotting_modules"])}' if len(x['plotting_modules']) > 0 else ''))
+    return results, all(len(x['plotting_modules']) == 0 for x in results)
+
+def check_chunked(workdir, chunksize = 1000):
+    """
+    Checks refining in chunks gives the same data as refining in memory, in every output format, when the first chunk has no valid
+    rows, and the second has a blank in a column allowing 'X' but no 'X', so the column is read as numbers in that chunk only.
+
+    Parameters:
+    - workdir (str): folder to write synthetic data to.
+    - chunksize (int): number of rows in each chunk, all invalid in the first.
+
+    Returns:
+    bool: True if every output format matched.
+    """
+    raw_path = os.path.join(workdir, 'synthetic_first_chunk_invalid.csv')
+    generate_data(raw_path, 1)
+    df = pd.read_csv(raw_path, dtype = str)
+    df.loc[:chunksize - 1, 'Region'] = '?'
+    second = df.index[chunksize:2 * chunksize]
+    df.loc[second, 'Industry'] = df.loc[second, 'Industry'].replace('X', '1')
+    df.loc[second[0], 'Industry'] = None
+    df.to_csv(raw_path, index = False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        dl = refined_loader(raw_path)
+        dl.drop_duplicates()
+    expected = dl.df.reset_index(drop = True)
+    # Refined values are all valid, so none should be missing
+    ok = not expected.isna().any().any()
+    for fmt, ext in OUTPUT_FORMATS.items():
+        path = raw_path[:-4] + '_refined' + ext
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                DataLoader(raw_path, chunksize = chunksize).refine_file(path, fmt)
+            pd.testing.assert_frame_equal(read_refined(path).reset_index(drop = True), expected, check_categorical = False)
+            result = 'same as in memory'
+        except Exception as e:
+            ok = False
+            result = f'{type(e).__name__}: {e}'.splitlines()[0]
+        print(f'chunked {fmt:<8}  {result}')
+    return ok
+
+def git_commit():
+    """
+    Gets the current git commit, so results can be compared between commits.
+
+    Returns:
+    str: short commit hash, or 'unknown' if not in a git repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+def compare(old_path, new_path):
+    """
+    Prints the change in time and memory of each stage between two results files.
+
+    Parameters:
+    - old_path (str): filepath of earlier results .json.
+    - new_path (str): filepath of later results .json.
+    """
+    with open(old_path) as f:
+        old = {(x['scale'], x['stage']): x for x in json.load(f)['results'] if 'error' not in x}
+    with open(new_path) as f:
+        new = {(x['scale'], x['stage']): x for x in json.load(f)['results'] if 'error' not in x}
+    print(f'{"Scale":>5}   {"Stage":<20}  {"Old (s)":>9}  {"New (s)":>9}  {"Speedup":>8}  {"Old MB":>9}  {"New MB":>9}')
+    for key in [x for x in new if x in old]:
+        o, n = old[key], new[key]
+        print(f'{key[0]:>5}x  {key[1]:<20}  {o["seconds"]:>9.3f}  {n["seconds"]:>9.3f}  {o["seconds"] / n["seconds"]:>7.2f}x  {o["peak_mb"]:>9.1f}  {n["peak_mb"]:>9.1f}')
+
+# If code ran from terminal, run benchmarks and save results
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10], help="Sizes of data to benchmark, as multiples of the 1PCT file, e.g. 1 10 100 1000")
+    parser.add_argument("--invalid-fraction", type=float, default=0.01, help="Fraction of rows given an invalid value")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs of each stage, fastest is reported")
+    parser.add_argument("--max-in-memory-rows", type=int, default=MAX_IN_MEMORY_ROWS, help="Largest number of rows to benchmark loading whole into memory, larger scales only benchmark the chunked route")
+    parser.add_argument("--workdir", type=str, default=None, help="Folder to write synthetic data to, defaults to a temporary folder")
+    parser.add_argument("--output", type=str, default=None, help="Filepath of results .json, defaults to 'benchmark_<commit>.json'")
+    parser.add_argument("--compare", type=str, nargs=2, default=None, metavar=("OLD", "NEW"), help="Compare two results files rather than running benchmarks")
+    parser.add_argument("--check-chunks", action="store_true", help="Only check refining in chunks gives the same data as in memory when the first chunk is all invalid, and exit with an error if not")
+    parser.add_argument("--check-imports", action="store_true", help="Only time imports, and exit with an error if loading data imports chart drawing modules")
+    args = parser.parse_args()
+    if args.compare is not None:
+        compare(*args.compare)
+    elif args.check_chunks:
+        with tempfile.TemporaryDirectory() as tmp:
+            if not check_chunked(args.workdir or tmp):
+                sys.exit(1)
+    elif args.check_imports:
+        imports, ok = check_imports(args.repeat)
+        if not ok:
+            print('Chart drawing modules should only be imported when a chart is drawn')
+            sys.exit(1)
+    else:
+        output = os.path.abspath(args.output or f'benchmark_{git_commit()}.json')
+        # Run from this folder, so the relative data paths used by the classes resolve as they do from the notebooks
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        imports, _ = check_imports(args.repeat)
+        with tempfile.TemporaryDirectory() as tmp:
+            workdir = args.workdir or tmp
+            results = []
+            for scale in args.scales:
+                results.extend(benchmark_scale(workdir, scale, args.invalid_fraction, args.repeat, args.max_in_memory_rows))
+        info = {'commit': git_commit(), 'timestamp': datetime.datetime.now().isoformat(timespec = 'seconds'), 'python': platform.python_version(),
+                'pandas': pd.__version__, 'numpy': np.__version__, 'invalid_fraction': args.invalid_fraction, 'repeat': args.repeat, 'imports': imports, 'results': results}
+        with open(output, 'w') as f:
+            json.dump(info, f, indent = 2)
+        print(f'Results saved to {output}')
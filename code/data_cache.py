@@ -0,0 +1,128 @@
+## code for a bounded least recently used cache, used to keep aggregated data and rendered charts for repeated widget states
+
+import io
+import sys
+from collections import OrderedDict
+import pandas as pd
+
+class LRUCache:
+    """
+    This class stores results up to a maximum number of entries and total size, dropping the least recently used first.
+    """
+    def __init__(self, maxsize = 128, max_bytes = 64 * 2 ** 20):
+        """
+        Constructor for LRUCache.
+
+        Parameters:
+        - maxsize (int): maximum number of entries to keep.
+        - max_bytes (int): maximum total size of entries to keep, in bytes.
+        """
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _size(self, value):
+        """
+        Estimates the memory used by a cached value.
+
+        Parameters:
+        - value: value to size.
+
+        Returns:
+        int: size in bytes.
+        """
+        if isinstance(value, pd.DataFrame):
+            return int(value.memory_usage(deep = True).sum())
+        if isinstance(value, pd.Series):
+            return int(value.memory_usage(deep = True))
+        if isinstance(value, tuple):
+            return sum(self._size(x) for x in value)
+        return sys.getsizeof(value)
+
+    def get(self, key, count = True):
+        """
+        Gets a cached value, marking it as most recently used.
+
+        Parameters:
+        - key (tuple): key value was stored under.
+        - count (bool): if False, leave the lookup out of hits and misses, e.g. for the parts of a result whose own lookup was already counted.
+
+        Returns:
+        Cached value, or None if not cached.
+        """
+        if key not in self._entries:
+            if count:
+                self.misses += 1
+            return None
+        if count:
+            self.hits += 1
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key, value):
+        """
+        Stores a value, dropping least recently used values until within maxsize and max_bytes. Values larger than max_bytes are not stored.
+
+        Parameters:
+        - key (tuple): key to store value under.
+        - value: value to store.
+        """
+        size = self._size(value)
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self._bytes += size
+        while len(self._entries) > self.maxsize or self._bytes > self.max_bytes:
+            self._bytes -= self._entries.popitem(last = False)[1][1]
+
+    def clear(self):
+        """
+        Removes all cached values and resets statistics.
+        """
+        self._entries.clear()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """
+        Gets usage statistics of the cache.
+
+        Returns:
+        dict: hits, misses, hit rate, number of entries and total bytes stored.
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'entries': len(self._entries), 'bytes': self._bytes}
+
+def print_cache_info(cache):
+    """
+    Prints hit and miss statistics of a cache.
+
+    Parameters:
+    - cache (LRUCache): cache to print statistics of.
+    """
+    stats = cache.stats()
+    print(f'Cache hits: {stats["hits"]}, misses: {stats["misses"]} ({stats["hit_rate"]:.0%} hit rate)')
+    print(f'Cache holds {stats["entries"]} entries, {stats["bytes"] / 2 ** 20:.1f} MB')
+
+def to_png(fig):
+    """
+    Renders a figure to PNG and closes it, so rendered charts can be cached.
+
+    Parameters:
+    - fig (plt.Figure): figure to render.
+
+    Returns:
+    bytes: PNG image.
+    """
+    import matplotlib.pyplot as plt
+    buf = io.BytesIO()
+    fig.savefig(buf, format = 'png', bbox_inches = 'tight')
+    plt.close(fig)
+    return buf.getvalue()
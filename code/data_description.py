@@ -1,25 +1,112 @@
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-from ipywidgets import interact, widgets
-import math
+from data_types import read_refined, load_variable_dict
+from data_aggregation import ContingencyCube, count_refined
+from data_cache import LRUCache, print_cache_info, to_png
+# seaborn, matplotlib and ipywidgets are slow to import, so are only imported by the methods drawing charts and widgets.
+# Loading, counting and describing data doesn't need them
 
-__name__ = "__main__"
+def grouped_frame(cube, col1, col2, col1_vals = 'None', col2_vals = 'None', summary_stats = 'None', proportional = 'Count'):
+    """
+    Slices the number of records for each pair of values of two columns out of a ContingencyCube, ready to plot as a heatmap.
+
+    Parameters:
+    - cube (ContingencyCube): counts of every pair of categorical columns.
+    - col1 (str): name of first column to group by.
+    - col2 (str): name of second column to group by.
+    - col1_vals (List[str]): values of column 1 to display.
+    - col2_vals (List[str]): values of column 2 to display.
+    - summary_stats (str): choose whether to display counts for only one column rather than a heatmap.
+    - proportional (str): choose whether to display count of records, or proportion of dataset.
+
+    Returns:
+    pd.DataFrame: number or proportion of records for each group.
+    str: format of heatmap annotations.
+    str: colour map of heatmap.
+    """
+    # Counts of every pair of values are precomputed, so slice out the table rather than grouping the data
+    grouped_df = cube.table(col1, col2)
+    # If specified, only select values parsed to function
+    if col1_vals != 'None':
+        grouped_df = grouped_df.loc[grouped_df.index.isin(col1_vals)]
+    if col2_vals != 'None':
+        grouped_df = grouped_df.loc[:, grouped_df.columns.isin(col2_vals)]
+    # Only keep values that occur in the selection, as grouping the data would
+    grouped_df = grouped_df.loc[grouped_df.sum(axis = 1) > 0, grouped_df.sum(axis = 0) > 0]
+    # Weighted or scaled counts may not be whole numbers
+    count_fmt = 'd' if pd.api.types.is_integer_dtype(grouped_df.to_numpy().dtype) else '.0f'
+    # If specified, group all values of specified column
+    if summary_stats in [col1, col2]:
+        grouped_df = pd.DataFrame(grouped_df.sum(axis = 1 if summary_stats == col1 else 0))
+        if proportional == 'Proportion':
+            grouped_df = grouped_df.div(grouped_df.sum().sum())
+            grouped_df.columns = ['Proportion of Records']
+            return grouped_df, '.2f', 'YlGnBu'
+        grouped_df.columns = ['Number of Records']
+        return grouped_df, count_fmt, 'YlGnBu'
+    # If want proportional output, perform calculation accordingly
+    if proportional == 'Proportion':
+        return grouped_df.div(grouped_df.sum().sum()), '.2f', 'coolwarm'
+    return grouped_df, count_fmt, 'coolwarm'
+
+def plot_heatmap(grouped_df, fmt, cmap):
+    """
+    Draws a heatmap of grouped data.
+
+    Parameters:
+    - grouped_df (pd.DataFrame): number or proportion of records for each group.
+    - fmt (str): format of heatmap annotations.
+    - cmap (str): colour map of heatmap.
+
+    Returns:
+    plt.Figure: heatmap.
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    fig = plt.figure(figsize=(14, 10))
+    sns.heatmap(grouped_df, annot=True, cmap=cmap, fmt=fmt, cbar=True, square = True, cbar_kws={'shrink': 0.5},
+                linecolor='gray', linewidth=0.2)
+    return fig
 
 class DataDescriber:
     """
     This class produces descriptions of a dataset.
     """
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache_size = 128, cache_max_bytes = 64 * 2 ** 20, chunksize = None, weight = None, scale = 1, service = None):
         """
         Constructor for DataDescriber.
 
         Parameters:
         - filepath (str): filepath where .csv data is found.
+        - cache_size (int): maximum number of grouped tables and heatmaps to cache.
+        - cache_max_bytes (int): maximum memory used by the cache, in bytes.
+        - chunksize (int): if given, the data is not kept in memory. Instead it is read in chunks of this many rows and only counted, for files larger than memory.
+        - weight (str): column giving the weight of each record. Counts are the sum of weights rather than the number of records.
+        - scale (int, float): number counts are multiplied by to estimate the population, e.g. 100 for a 1% sample.
+        - service (str): address of a running data_service.py, e.g. 'http://localhost:8765'. If given, counts are queried from it rather than read from filepath, so notebooks share one copy of the data.
         """
+        self.cache = LRUCache(cache_size, cache_max_bytes)
+        self.client = None
+        # Weights are summed rather than described
+        self.weight = weight
         try:
-            self.df = pd.read_csv(filepath)
-            self.df.set_index(self.df.columns[0], drop = True, inplace = True)
+            if service != None:
+                # Imported here, as the service itself uses grouped_frame from this module
+                from data_service import ServiceClient
+                self.client = ServiceClient(service)
+                # Client answers the same questions as a ContingencyCube, asking the service
+                self.cube = self.client
+                self.dtypes = self.client.dtypes
+                self.weight = self.client.weight
+            elif chunksize is None:
+                self.df = read_refined(filepath)
+                self.dtypes = self.df.dtypes
+                # Count every pair of categorical columns once, for heatmaps
+                self.cube = ContingencyCube(self.df.select_dtypes('category').columns, weighted = weight != None, scale = scale)
+                self.cube.update(self.df, self.df[weight] if weight != None else None)
+            else:
+                self.cube, self.dtypes = count_refined(filepath, chunksize, weight = weight, scale = scale)
+            # Descriptions only use the counts, so work the same whether or not the data is kept
+            self.columns = self.dtypes.index
             self._value_interpreter()
         except Exception as e:
             print('File could not be read')
@@ -29,75 +116,78 @@ class DataDescriber:
         """ 
         Method to read in descriptions from helper file.
         """
-        # Read in data
-        desc_df = pd.read_excel('..\data\Teaching_File_Variable_List.xlsx')
-        desc_df.drop(0, inplace = True)
-
-        # Clean data, replacing NaN values
-        for i in range(len(desc_df['Variable Name'])):
-            try:
-                if math.isnan(desc_df.iloc[i, 0]):
-                    desc_df.iloc[i, 0] = desc_df.iloc[i - 1, 0]
-                    desc_df.iloc[i, 1] = desc_df.iloc[i - 1, 1]
-            except:
-                next
-
-        # Create columns for alphanumeric character and description
-        desc_df[['Alphanumerical', 'Desc']] = desc_df['Variable Values'].str.split('.', expand=True)
-        desc_df.drop(columns=['Variable Values'], inplace=True)
-        desc_df['Desc'] = desc_df['Desc'].str.strip()
-        desc_df.loc[desc_df['Variable Name'] == 'Student (Schoolchild or full-time student)', 'Variable Name'] = 'Student'
-        desc_df.loc[desc_df['Variable Name'] == 'Health (General health)', 'Variable Name'] = 'Health'
+        self.variable_dict = load_variable_dict()
 
-        # Record in dictionary
-        self.variable_dict = {k:{v: s for v, s in zip(desc_df.loc[desc_df['Variable Name'] == k, 'Alphanumerical'], desc_df.loc[desc_df['Variable Name'] == k, 'Desc'])} for k in desc_df['Variable Name']}
-
-    def _sort_list(self, list):
+    def _col_values(self, col):
         """
-        Sorts column values, taking into account whether string or int.
+        Gets the values a column takes, in order. Columns are held as ordered categoricals, so this is the order of the categories.
 
-        Paramters:
-        - list (List[str, int]): list of values to sort.
+        Parameters:
+        - col (str): column to get values of.
 
         Returns:
-        List[str, int]: list in sorted order.
+        List[str, int]: values present in column, in sorted order.
         """
-        if 'X' in list:
-            sorted_cols = [str(x) for x in sorted([int(x) for x in list if x != 'X'])]
-            sorted_cols.append('X')
-        else:
-            sorted_cols = sorted(list)
-        return(sorted_cols)
+        counts = self.cube.frequencies(col)
+        return list(counts.index[counts > 0])
 
     def no_records(self):
         """
         Prints the number of records in the dataset.
         """
-        n = len(self.df)
+        n = self.cube.n_records
         print(f'The data set has {n} rows')
+        if self.cube.weighted or self.cube.scale != 1:
+            print(f'Representing an estimated population of {self.cube.total():.0f}')
 
     def col_types(self):
         """
         Prints the type of data for each column in the dataset.
         """
-        for i in self.df.columns:
-            dtype = type(self.df[i][0])
+        for i in self.columns:
+            dtype = self.dtypes[i]
             print(f'Column {i} is of data type {dtype}')
         
     def unique_values(self):
         """
         Prints the unique values for each column in dataset.
         """
-        cols = [x for x in list(self.df.columns) if x not in ['Record_Number', 'Region']]
+        cols = [x for x in list(self.columns) if x not in ['Record_Number', 'Region', self.weight]]
         for i in cols:
-            vals = self.df[i].unique()
-            vals.sort()
+            vals = self._col_values(i)
             vals_int = [f'{x} ({self.variable_dict[i][str(x)]})' for x in vals]
             print(f'Column {i} takes values {vals_int}')
 
+    def _grouped_frame(self, col1, col2, col1_vals, col2_vals, summary_stats, proportional):
+        """
+        Groups dataset by specified columns, ready to plot as a heatmap. See _grouped_no_records for parameters.
+
+        Returns:
+        pd.DataFrame: number or proportion of records for each group.
+        str: format of heatmap annotations.
+        str: colour map of heatmap.
+        """
+        if self.client != None:
+            return self.client.grouped_frame(col1, col2, col1_vals, col2_vals, summary_stats, proportional)
+        return grouped_frame(self.cube, col1, col2, col1_vals, col2_vals, summary_stats, proportional)
+
+    def _state_key(self, vals):
+        """
+        Normalises a selection of values from a widget, so the same selection in any order gives the same cache key.
+
+        Parameters:
+        - vals (List[str] or str): selected values, or 'None'.
+
+        Returns:
+        tuple or str: normalised selection.
+        """
+        if isinstance(vals, str):
+            return vals
+        return tuple(sorted(set(vals), key = str))
+
     def _grouped_no_records(self, col1, col2, col1_vals = 'None', col2_vals = 'None', summary_stats = 'None', proportional = 'Count'):
         """
-        Groups dataset by specified columns and produces heatmap
+        Groups dataset by specified columns and produces heatmap. Grouped data and rendered heatmaps are cached, so returning to a previous selection is instant.
 
         Parameters:
         - col1 (str): name of first column to groupby.
@@ -107,67 +197,27 @@ class DataDescriber:
         - summary_stats (str): choose whether to display counts for only one column rather than a heatmap.
         - proportional (str): choose whether to display count of records, or proportion of dataset.
         """
-        grouped_mi = self.df.groupby([col1, col2])['Record_Number'].count()
-        grouped_df = pd.DataFrame(grouped_mi)
-        # If specified, only select values parsed to function
-        if col1_vals != 'None':
-            grouped_df = grouped_df[grouped_df.index.get_level_values(0).isin(col1_vals)] 
-        if col2_vals != 'None':
-            grouped_df = grouped_df[grouped_df.index.get_level_values(1).isin(col2_vals)]
-        # If specified, group all values of specified column
-        if summary_stats == col1:
-            if col1 == col2:
-                grouped_df.index = grouped_df.index.droplevel(1)
-            else:
-                grouped_df.index = grouped_df.index.droplevel(col2)
-            grouped_df = grouped_df.groupby(col1).sum()
-            if proportional == 'Proportion':
-                grouped_df = grouped_df.div(grouped_df.sum().sum())
-                grouped_df.rename(columns = {'Record_Number': 'Proportion of Records'}, inplace = True)
-                fmt = '.2f'
-            else:
-                grouped_df.rename(columns = {'Record_Number': 'Number of Records'}, inplace = True)
-                fmt = 'd'
-            plt.figure(figsize=(14, 10))
-            sns.heatmap(grouped_df, annot=True, cmap="YlGnBu", fmt=fmt, cbar=True, square = True, cbar_kws={'shrink': 0.5},
-                    linecolor='gray', linewidth=0.2)
-            return
-        # Following code same as above if statement for column 2
-        if summary_stats == col2:
-            if col1 == col2:
-                grouped_df.index = grouped_df.index.droplevel(1)
-            else:
-                grouped_df.index = grouped_df.index.droplevel(col1)
-            grouped_df = grouped_df.groupby(col2).sum()
-            if proportional == 'Proportion':
-                grouped_df = grouped_df.div(grouped_df.sum().sum())
-                grouped_df.rename(columns = {'Record_Number': 'Proportion of Records'}, inplace = True)
-                fmt = '.2f'
-            else:
-                grouped_df.rename(columns = {'Record_Number': 'Number of Records'}, inplace = True)
-                fmt = 'd'
-            plt.figure(figsize=(14, 10))
-            sns.heatmap(grouped_df, annot=True, cmap="YlGnBu", fmt=fmt, cbar=True, square = True, cbar_kws={'shrink': 0.5},
-                        linecolor='gray', linewidth=0.2)
-            return
-        # If do not want summary stats, produce standard grid
-        grouped_df = grouped_df.unstack().fillna(0).astype(int)
-        grouped_df.columns = grouped_df.columns.droplevel()
-        sorted_cols = self._sort_list(grouped_df.columns)
-        grouped_df = grouped_df.reindex(sorted_cols, axis = 1)
-        fmt = 'd'
-
-        # If want proportional output, perform calculation accordingly
-        if proportional == 'Proportion':
-            grouped_df = grouped_df.div(grouped_df.sum().sum())
-            fmt = '.2f'
-        
-        # Plot heatmap
-        plt.figure(figsize=(14, 10))
-        sns.heatmap(grouped_df, annot=True, cmap="coolwarm", fmt=fmt, cbar=True, square = True, cbar_kws={'shrink': 0.5},
-                    linecolor='gray', linewidth=0.2)
-        plt.show()
-        
+        from IPython.display import display, Image
+        key = (col1, col2, self._state_key(col1_vals), self._state_key(col2_vals), summary_stats, proportional)
+        png = self.cache.get(('png',) + key)
+        if png is None:
+            # Only the heatmap lookup is counted, as this is part of the same request
+            frame = self.cache.get(('frame',) + key, count = False)
+            if frame is None:
+                frame = self._grouped_frame(col1, col2, col1_vals, col2_vals, summary_stats, proportional)
+                self.cache.put(('frame',) + key, frame)
+            grouped_df, fmt, cmap = frame
+            # Plot heatmap
+            png = to_png(plot_heatmap(grouped_df, fmt, cmap))
+            self.cache.put(('png',) + key, png)
+        display(Image(data = png))
+
+    def cache_info(self):
+        """
+        Prints hit and miss statistics of the cache of grouped data and heatmaps.
+        """
+        print_cache_info(self.cache)
+
     def _update_col1_values(self, col1):
         """
         Updates widgets according to column 1 selected
@@ -175,7 +225,7 @@ class DataDescriber:
         Parameters:
         - col1 (str): column 1 selected to filter by
         """
-        unique_values = self._sort_list(self.df[col1].unique())
+        unique_values = self._col_values(col1)
         self.col1_vals.options = unique_values
         self.col1_vals.value = unique_values
         self.col1_vals.description = f'{col1}: '
@@ -191,7 +241,7 @@ class DataDescriber:
         Parameters:
         - col1 (str): column 2 selected to filter by
         """
-        unique_values = self._sort_list(self.df[col2].unique())
+        unique_values = self._col_values(col2)
         self.col2_vals.options = unique_values
         self.col2_vals.value = unique_values
         self.col2_vals.description = f'{col2}: '
@@ -205,15 +255,16 @@ class DataDescriber:
         """
         Produces widgets to interact with heatmap created by _grouped_no_records
         """
+        from ipywidgets import interact, widgets
         # Dropdown menu widgets for column 1, column 2, and summary_stats
-        self.dropdown1 = widgets.Dropdown(options=self.df.columns.drop('Record_Number'), value='Age', description='Factor: ')
-        self.dropdown2 = widgets.Dropdown(options=self.df.columns.drop('Record_Number'), value='Health', description='Factor: ')
+        self.dropdown1 = widgets.Dropdown(options=self.columns.drop(['Record_Number', self.weight], errors = 'ignore'), value='Age', description='Factor: ')
+        self.dropdown2 = widgets.Dropdown(options=self.columns.drop(['Record_Number', self.weight], errors = 'ignore'), value='Health', description='Factor: ')
         self.dropdown3 = widgets.Dropdown(options=['Count', 'Proportion'], value='Count', description='Factor: ')
         # Checkbox widgets for selecting column values to display
         style = {'description_width': 'initial'}
-        col1_values = self._sort_list(self.df[self.dropdown1.value].unique())
+        col1_values = self._col_values(self.dropdown1.value)
         self.col1_vals = widgets.SelectMultiple(options=col1_values, value=col1_values, description=f'{self.dropdown1.value}:', style = style)
-        col2_values = self._sort_list(self.df[self.dropdown2.value].unique())
+        col2_values = self._col_values(self.dropdown2.value)
         self.col2_vals = widgets.SelectMultiple(options=col2_values, value=col2_values, description=f'{self.dropdown2.value}:', style = style)
         self.dropdown4 = widgets.Dropdown(options = ['None', self.dropdown1.value, self.dropdown2.value], value = 'None', description = 'Summary stats: ', style = style)
         
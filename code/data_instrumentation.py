@@ -0,0 +1,107 @@
+## code to record the time, rows and memory of each stage of refinement, so slow stages can be found
+
+import contextlib
+import json
+import time
+import tracemalloc
+
+class StageReport:
+    """
+    This class records wall time, rows in and out, and peak memory of named stages. Repeated stages, such as the
+    same check on each chunk of a file, are summed into one entry.
+    """
+    def __init__(self, trace_memory = False, json_log = None, hooks = None):
+        """
+        Constructor for StageReport.
+
+        Parameters:
+        - trace_memory (bool): if True, record peak memory allocated in each stage using tracemalloc. Slows stages down.
+        - json_log (str): if given, filepath to append each finished stage to as a line of JSON.
+        - hooks (List[function]): functions called with the dict of each finished stage, e.g. to send to a monitoring system.
+        """
+        self.trace_memory = trace_memory
+        self.json_log = json_log
+        self.hooks = list(hooks) if hooks != None else []
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in = None):
+        """
+        Context manager timing a stage. Set 'rows_out' of the dict it yields if the stage changes the number of rows.
+
+        Parameters:
+        - name (str): name of stage.
+        - rows_in (int): number of rows going into stage.
+        """
+        record = {'rows_in': rows_in, 'rows_out': rows_in}
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield record
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] - base if self.trace_memory else None
+        self.add(name, seconds, record['rows_in'], record['rows_out'], peak)
+
+    def add(self, name, seconds, rows_in = None, rows_out = None, peak_bytes = None):
+        """
+        Adds a finished stage to the report, and passes it to the JSON log and hooks.
+
+        Parameters:
+        - name (str): name of stage.
+        - seconds (float): wall time of stage.
+        - rows_in (int): number of rows going into stage.
+        - rows_out (int): number of rows coming out of stage.
+        - peak_bytes (int): peak memory allocated during stage, in bytes.
+        """
+        event = {'stage': name, 'seconds': seconds, 'rows_in': rows_in, 'rows_out': rows_out,
+                 'rows_dropped': rows_in - rows_out if rows_in != None and rows_out != None else None,
+                 'peak_memory_mb': peak_bytes / 2 ** 20 if peak_bytes != None else None}
+        if name not in self.stages:
+            self.stages[name] = {**event, 'calls': 0, 'seconds': 0.0, 'rows_in': None, 'rows_out': None, 'rows_dropped': None, 'peak_memory_mb': None}
+        total = self.stages[name]
+        total['calls'] += 1
+        total['seconds'] += seconds
+        for key in ['rows_in', 'rows_out', 'rows_dropped']:
+            if event[key] != None:
+                total[key] = (total[key] or 0) + event[key]
+        if event['peak_memory_mb'] != None:
+            total['peak_memory_mb'] = max(total['peak_memory_mb'] or 0, event['peak_memory_mb'])
+        if self.json_log != None:
+            with open(self.json_log, 'a') as f:
+                f.write(json.dumps(event) + '\n')
+        for hook in self.hooks:
+            hook(event)
+
+    def to_dict(self):
+        """
+        Gets the report as a dict, for saving as JSON.
+
+        Returns:
+        dict: total time and list of stages in the order first run.
+        """
+        return {'total_seconds': sum(x['seconds'] for x in self.stages.values()), 'stages': list(self.stages.values())}
+
+    def to_json(self, path):
+        """
+        Saves the report as JSON.
+
+        Parameters:
+        - path (str): filepath to save to.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent = 2)
+
+    def summary(self):
+        """
+        Prints a table of stages, slowest first.
+        """
+        width = max([len(x) for x in self.stages] + [5])
+        print(f'{"Stage":<{width}}  {"Calls":>6}  {"Seconds":>9}  {"Rows in":>10}  {"Dropped":>10}  {"Peak MB":>9}')
+        for x in sorted(self.stages.values(), key = lambda x: x['seconds'], reverse = True):
+            rows_in = x['rows_in'] if x['rows_in'] != None else ''
+            dropped = x['rows_dropped'] if x['rows_dropped'] != None else ''
+            peak = f'{x["peak_memory_mb"]:.1f}' if x['peak_memory_mb'] != None else ''
+            print(f'{x["stage"]:<{width}}  {x["calls"]:>6}  {x["seconds"]:>9.3f}  {rows_in:>10}  {dropped:>10}  {peak:>9}')
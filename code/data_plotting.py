@@ -1,24 +1,115 @@
-import matplotlib.pyplot as plt
-import pandas as pd
-from ipywidgets import interact, widgets
+import numpy as np
+from data_types import read_refined
+from data_aggregation import ContingencyCube, count_refined
+from data_cache import LRUCache, print_cache_info, to_png
+# matplotlib and ipywidgets are slow to import, so are only imported by the functions drawing charts and widgets
 
-__name__ = "__main__"
+def plot_bar_chart(counts, col):
+    """ 
+    Function to draw bar chart of number of occurrences of each category for a column
+
+    Parameters:
+     - counts (pd.Series): number of occurrences of each category
+     - col (str): column header counts are of
+
+    Returns:
+    plt.Figure: bar chart
+    """
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize=(8, 6))
+    counts.plot(kind='bar')
+    plt.title('Number of Occurrences')
+    plt.xlabel(col)
+    plt.ylabel('Occurrences')
+    plt.xticks(rotation=0)  # Rotate x labels if needed
+    plt.grid(axis='y', linestyle='--', alpha=0.7)
+    return fig
+
+def plot_pie_chart(counts, col, explode_val, explode_max):
+    """ 
+    Function to draw pie chart showing percentage of entries belonging to each category
+
+    Parameters:
+     - counts (pd.Series): number of occurrences of each category
+     - col (str): column header counts are of
+     - explode_val (float [0, inf)): number defining how much to explode small values
+     - explode_max (float [0, 1]): number defining max percentage to explode
+
+    Returns:
+    plt.Figure: pie chart
+    """
+    import matplotlib.pyplot as plt
+    # Highlight the dominant category
+    explode = np.where(counts / counts.sum() >= explode_max, 0, explode_val)
+    # Plot the pie chart            
+    fig = plt.figure(figsize=(8, 6))
+    plt.pie(counts, labels=counts.index, autopct='%1.1f%%', startangle=140, explode=explode)
+    plt.title(f'Proportion of Occurrences for each category of {col.capitalize()}')
+    plt.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
+    return fig
 
 class DataPlotter:
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache_size = 128, cache_max_bytes = 64 * 2 ** 20, chunksize = None, weight = None, scale = 1, service = None):
         """ 
         Constructor for DataPlotter class
 
         Parameters:
          - filepath (str): filepath of .csv file containing data to read in
+         - cache_size (int): maximum number of value counts and charts to cache
+         - cache_max_bytes (int): maximum memory used by the cache, in bytes
+         - chunksize (int): if given, the data is not kept in memory. Instead it is read in chunks of this many rows and only counted, for files larger than memory
+         - weight (str): column giving the weight of each record. Counts are the sum of weights rather than the number of records
+         - scale (int, float): number counts are multiplied by to estimate the population, e.g. 100 for a 1% sample
+         - service (str): address of a running data_service.py, e.g. 'http://localhost:8765'. If given, counts are queried from it rather than read from filepath, so notebooks share one copy of the data
         """
+        self.cache = LRUCache(cache_size, cache_max_bytes)
+        # Weights are summed rather than charted
+        self.weight = weight
         try:
-            self.df = pd.read_csv(filepath)
-            self.df.set_index(self.df.columns[0], drop = True, inplace = True)
+            if service != None:
+                from data_service import ServiceClient
+                # Client answers the same questions as a ContingencyCube, asking the service
+                self.cube = ServiceClient(service)
+                self.columns = self.cube.columns
+                self.weight = self.cube.weight
+            elif chunksize is None:
+                self.df = read_refined(filepath)
+                self.columns = self.df.columns
+                # Charts only need the number of each value of each column, not pairs
+                self.cube = ContingencyCube(self.df.select_dtypes('category').columns, pairs = False, weighted = weight != None, scale = scale)
+                self.cube.update(self.df, self.df[weight] if weight != None else None)
+            else:
+                self.cube, dtypes = count_refined(filepath, chunksize, pairs = False, weight = weight, scale = scale)
+                self.columns = dtypes.index
         except Exception as e:
             print('File could not be read')
             print(f'Error: {e}')
 
+    def _counts(self, col):
+        """ 
+        Method to get number of occurrences of each category for a column, cached between charts
+
+        Parameters:
+         - col (str): column header to count values of
+
+        Returns:
+        pd.Series: number of occurrences of each category present, in category order
+        """
+        # Only the chart lookup is counted, as counts are only needed for a chart not yet cached
+        counts = self.cache.get(('counts', col), count = False)
+        if counts is None:
+            counts = self.cube.frequencies(col)
+            # Every category is counted, so drop those not present
+            counts = counts[counts > 0]
+            self.cache.put(('counts', col), counts)
+        return counts
+
+    def cache_info(self):
+        """ 
+        Method to print hit and miss statistics of the cache of value counts and charts
+        """
+        print_cache_info(self.cache)
+
     def _plot_bar_chart(self, col):
         """ 
         Method to plot bar chart of number of occurrences of each category for a column
@@ -29,25 +120,23 @@ class DataPlotter:
         Returns:
         Bar chart of number of occurrences of each category for a column
         """
-        # Get the value counts for the column
-        counts = self.df[col].value_counts().sort_index()
-
-        # Plotting
-        plt.figure(figsize=(8, 6))
-        counts.plot(kind='bar')
-        plt.title('Number of Occurrences')
-        plt.xlabel(col)
-        plt.ylabel('Occurrences')
-        plt.xticks(rotation=0)  # Rotate x labels if needed
-        plt.grid(axis='y', linestyle='--', alpha=0.7)
-        plt.show()
+        from IPython.display import display, Image
+        # Rendered charts are cached, so only plot if not seen before
+        png = self.cache.get(('bar', col))
+        if png is None:
+            # Get the value counts for the column
+            counts = self._counts(col)
+            png = to_png(plot_bar_chart(counts, col))
+            self.cache.put(('bar', col), png)
+        display(Image(data = png))
 
     def bar_chart(self):
         """ 
         Method to plot interactive bar chart using ipywidgets
         """
+        from ipywidgets import interact, widgets
         # Dropdown menu widget
-        self.dropdown = widgets.Dropdown(options=self.df.columns.drop('Record_Number'), value='age', description='Factor: ')
+        self.dropdown = widgets.Dropdown(options=self.columns.drop(['Record_Number', self.weight], errors = 'ignore'), value='age', description='Factor: ')
 
         # Interactive widget to update the plot based on dropdown selection
         interact(self._plot_bar_chart, col=self.dropdown)
@@ -64,24 +153,24 @@ class DataPlotter:
         Returns:
         Pie chart showing percentage of entries belonging to each category
         """
-        # Get the value counts for the column
-        counts = self.df[col].value_counts().sort_index()
-
-        # Highlight the dominant category
-        explode = [0 if counts[x] / sum(counts) >= explode_max else explode_val for x in counts.index]
-        # Plot the pie chart            
-        plt.figure(figsize=(8, 6))
-        plt.pie(counts, labels=counts.index, autopct='%1.1f%%', startangle=140, explode=explode)
-        plt.title(f'Proportion of Occurrences for each category of {col.capitalize()}')
-        plt.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-        plt.show() 
+        from IPython.display import display, Image
+        # Rendered charts are cached, so only plot if not seen before. Round slider values so float noise doesn't miss the cache
+        key = ('pie', col, round(explode_val, 6), round(explode_max, 6))
+        png = self.cache.get(key)
+        if png is None:
+            # Get the value counts for the column
+            counts = self._counts(col)
+            png = to_png(plot_pie_chart(counts, col, explode_val, explode_max))
+            self.cache.put(key, png)
+        display(Image(data = png))
 
     def pie_chart(self):
         """ 
         Method to create an interactive pie chart using ipywidgets
         """
+        from ipywidgets import interact, widgets
         # Dropdown menu widget
-        self.dropdown = widgets.Dropdown(options=self.df.columns.drop('Record_Number'), value='Age', description='Factor: ')
+        self.dropdown = widgets.Dropdown(options=self.columns.drop(['Record_Number', self.weight], errors = 'ignore'), value='Age', description='Factor: ')
 
         # Sliders to control explosion
         layout = widgets.Layout(width = '20%')
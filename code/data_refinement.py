@@ -1,23 +1,128 @@
 ## code to read in and refine data. Can be called from terminal, or DataLoader class imported
 
 import pandas as pd
-import re
+import numpy as np
 import argparse
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from data_types import REFINEMENT_SCHEMA, OUTPUT_FORMATS, RefinedWriter, iter_refined, to_typed, write_cache
+from data_instrumentation import StageReport
+
+# define class to remember rows already seen, to find duplicates without keeping the rows themselves
+class FingerprintSet:
+    """ 
+    This class holds 64 bit fingerprints (hashes) of rows as a sorted array, so memory is 8 bytes per distinct row
+    """
+    def __init__(self):
+        """ 
+        Constructor for FingerprintSet, starting empty
+        """
+        self._sorted = np.array([], dtype = np.uint64)
+
+    def __len__(self):
+        return len(self._sorted)
+
+    def contains(self, fingerprints):
+        """ 
+        Method to check which fingerprints are already in the set
+
+        Parameters:
+         - fingerprints (np.ndarray): uint64 fingerprints to look up
+
+        Returns:
+        np.ndarray: True where fingerprint already in set
+        """
+        if len(self._sorted) == 0:
+            return np.zeros(len(fingerprints), dtype = bool)
+        idx = np.searchsorted(self._sorted, fingerprints).clip(max = len(self._sorted) - 1)
+        return self._sorted[idx] == fingerprints
+
+    def add(self, fingerprints):
+        """ 
+        Method to add fingerprints to the set
+
+        Parameters:
+         - fingerprints (np.ndarray): uint64 fingerprints to add
+        """
+        new = np.unique(fingerprints)
+        new = new[~self.contains(new)]
+        # Both arrays already sorted, which a stable sort merges in linear time
+        self._sorted = np.sort(np.concatenate([self._sorted, new]), kind = 'stable')
+
+    def save(self, path):
+        """ 
+        Method to save the set to a .npy file
+
+        Parameters:
+         - path (str): filepath to save to
+        """
+        np.save(path, self._sorted)
+
+    def load(self, path):
+        """ 
+        Method to load a set saved by save, replacing the current contents
+
+        Parameters:
+         - path (str): filepath to load from
+        """
+        self._sorted = np.load(path)
+
+def _regex_mask(values, regex):
+    """ 
+    Function to check part of a column against a regular expression, run in a worker process by DataLoader. Regular expressions
+    are matched in Python a value at a time, holding the GIL, so only separate processes run them at once
+
+    Parameters:
+     - values (np.ndarray): part of column to check
+     - regex (str): form of acceptable entries
+
+    Returns:
+    np.ndarray: True for rows with invalid values
+    """
+    return (~pd.Series(values).astype(str).str.fullmatch(regex)).to_numpy()
 
 # define class to load and refine data
 class DataLoader:
     """ 
     This class loads in and refines the parsed dataset
     """
-    def __init__(self, filepath):
+    def __init__(self, filepath, chunksize = None, report = None, check_workers = None, duplicate_exclude = []):
         """
-        Constructor for DataDescriber.
+        Constructor for DataLoader.
 
         Parameters:
         - filepath (str): filepath where .csv data is found.
+        - chunksize (int): if given, the file is not loaded into memory. Instead it is streamed in chunks of this many rows by refine_file.
+        - report (StageReport): records time, rows and memory of each stage. A new one that only records time and rows is made if not given.
+        - check_workers (int): if given, refine_data checks all columns at once, with this many threads and processes. Otherwise columns are checked one after another.
+        - duplicate_exclude (list): columns drop_duplicates ignores when comparing rows, e.g. ['Record_Number'] to also drop records repeated under a new number. By default rows must match in every column, as people giving the same answers are different records.
         """
+        self.filepath = filepath
+        self.chunksize = chunksize
+        self.check_workers = check_workers
+        self.duplicate_exclude = list(duplicate_exclude)
+        # Thread and process pools of refine_data, started by the first check and kept for every chunk
+        self._pools = None
+        self.report = report if report != None else StageReport()
+        # Fingerprints of rows already kept, used to find duplicates across chunk boundaries
+        self._seen_rows = FingerprintSet()
+        # Counts of rows checked and dropped, summarised when refining several files
+        self.n_checked = 0
+        self.error_counts = {}
+        self.n_duplicates = 0
+        if chunksize is not None:
+            return
         try:
-            self.df = pd.read_csv(filepath)
+            with self.report.stage('read_csv') as record:
+                self.df = pd.read_csv(filepath)
+                record['rows_out'] = len(self.df)
         except Exception as e:
             print('File could not be read')
             print(f'Error: {e}')
@@ -37,137 +142,518 @@ class DataLoader:
             # Store the mapping in the dictionary
             new_column_names[column] = new_column_name
 
-        self.df.rename(columns=new_column_names, inplace=True)
+        with self.report.stage('rename_cols', len(self.df)):
+            self.df.rename(columns=new_column_names, inplace=True)
         
     def _error_handler(self, col, errors):
         """ 
-        Method to print error rows and drop from df
+        Method to print error rows
 
         Parameters:
          - col (str): column that contains error
-         - errors (list): list of values causing errors in column
+         - errors (pd.Index): index of rows with errors in column
 
         Returns:
-        Prints error warnings and drops rows with errors in
+        Prints error warnings. Rows are dropped once all columns are checked by refine_data
         """
         print(f'The following records contain invalid data types in column \'{col}\': ')
-        print(self.df.loc[errors.index, 'Record_Number'].to_string(index = False))
+        print(self.df.loc[errors, 'Record_Number'].to_string(index = False))
         print('Dropping records from data')
-        self.df.drop(index = errors.index, inplace = True)
+        self.error_counts[col] = self.error_counts.get(col, 0) + len(errors)
 
-    def _integer_checker(self, col, min = None, max = None, include_x = False):
+    def _integer_checker(self, data, min = None, max = None, include_x = False):
         """ 
         Method for checking columns expected to be integeres, with or without 'X' as well
 
         Parameters:
-         - col (str): column to check
+         - data (pd.Series): column to check
          - min (int): minimum integer value column can take
          - max (int): maximum integer value column can take
          - include_x (bool): True if 'X' is a valid value
+
+        Returns:
+        pd.Series: True for rows with invalid values
         """
-        data = self.df[col]
-        # Quicker method if range of acceptable values known
-        if max != None and min != None:
-            vals = list(range(min, max + 1))
-            if include_x == True:
-                vals.append('X')
-                # If x included, values are stored as strings
-                vals = [str(x) for x in vals]
-            err = data[~data.isin(vals)]
-        # Alternative if one of min or max, or all integers acceptable
-        else:
-            err = data[data.apply(lambda x: not str(x).isdigit())]
-            data = data.drop(index = err.index).astype(int)
-            if max != None:
-                err = pd.concat([err, data[data > max]])
-            elif min != None:
-                err = pd.concat([err, data[data < max]])
-            if include_x == True:
-                err = err[err != 'X']
-
-        # Handle error rows
-        if len(err) > 0:
-            self._error_handler(col, err)
+        if pd.api.types.is_numeric_dtype(data):
+            num = data
+            is_x = False
+        # Column read as strings if it contains 'X' or other non numeric values
         else:
-            print(f'All data values in column \'{col}\' match expected data type')
+            text = data.astype(str)
+            # Quicker method if range of acceptable values known, a single lookup of the allowed strings
+            if max != None and min != None:
+                vals = [str(x) for x in range(min, max + 1)]
+                if include_x == True:
+                    vals.append('X')
+                return ~text.isin(vals)
+            # Otherwise only accept strings of digits
+            num = pd.to_numeric(text.where(text.str.fullmatch(r'\d+')), errors = 'coerce')
+            is_x = (text == 'X') if include_x == True else False
+        valid = num.notna() & (num % 1 == 0)
+        if min != None:
+            valid &= num >= min
+        if max != None:
+            valid &= num <= max
+        return ~(valid | is_x)
 
-    def _known_values_checker(self, col, vals):
+    def _known_values_checker(self, data, vals):
         """ 
         Method to check if values in defined list of possible values
 
         Parameters:
-         - col (str): column to check values of
+         - data (pd.Series): column to check values of
          - vals (list): list of acceptable values for column
-        """
-        data = self.df[col]
-        err = data[~data.isin(vals)]
-        # Handle error rows
-        if len(err) > 0:
-            self._error_handler(col, err)
-        else:
-            print(f'All data values in column \'{col}\' match expected data type')
 
+        Returns:
+        pd.Series: True for rows with invalid values
+        """
+        return ~data.isin(vals)
 
-    def _string_checker(self, col, regex):
+    def _string_checker(self, data, regex):
         """ 
         Method to check if values are of acceptable regular expression form
 
         Parameters:
-         - col (str): column to check values of
+         - data (pd.Series): column to check values of
          - regex (str): form of acceptable entries
+
+        Returns:
+        pd.Series: True for rows with invalid values
         """
-        data = self.df[col]
-        err = data[~data.apply(lambda x: bool(regex.match(x)))]
-        # Handle error rows
-        if len(err) > 0:
-            self._error_handler(col, err)
-        else:
-            print(f'All data values in column \'{col}\' match expected data type')
+        return ~data.astype(str).str.fullmatch(regex)
+
+    def _close_pools(self):
+        """ 
+        Method to shut down the thread and process pools of refine_data, if started
+        """
+        if self._pools != None:
+            for pool in self._pools:
+                pool.shutdown()
+            self._pools = None
+
+    def _parallel_masks(self, checkers):
+        """ 
+        Method to check every column at once. The data is only read by the checks, and isn't changed until all are done. Vectorised
+        checks run in threads, as pandas releases the GIL for much of their work. Regular expression checks are split into parts, one
+        per worker, and run in processes. Pools are started once and kept for every chunk, until refine_file or refine_incremental ends
+
+        Parameters:
+         - checkers (dict): method checking each type of column
+
+        Returns:
+        list: np.ndarray, True for rows with invalid values, for each column in order of REFINEMENT_SCHEMA
+        """
+        if self._pools == None:
+            self._pools = (ThreadPoolExecutor(self.check_workers), ProcessPoolExecutor(self.check_workers))
+        threads, processes = self._pools
+        bounds = np.linspace(0, len(self.df), self.check_workers + 1).astype(int)
+        futures = []
+        for col, checker, kwargs in REFINEMENT_SCHEMA:
+            if checker == 'string':
+                # Values sent without the index, as each part is copied to its process
+                values = self.df[col].to_numpy()
+                futures.append([processes.submit(_regex_mask, values[a:b], **kwargs) for a, b in zip(bounds[:-1], bounds[1:])])
+            else:
+                futures.append([threads.submit(checkers[checker], self.df[col], **kwargs)])
+        # Parts joined back in order, so masks line up with the rows
+        masks = [np.concatenate([np.asarray(x.result()) for x in parts]) for parts in futures]
+        # The in memory route checks once, so has no use for the pools afterwards
+        if self.chunksize is None:
+            self._close_pools()
+        return masks
 
     def refine_data(self):
         """ 
         Method to check values of 'Scotland_teaching_file_1PCT.csv' as defined in 'Teaching_File_Variable_List.csv'. Drops rows that aren't. See data folder for more info
         """
-        self._integer_checker('Record_Number', min = 1)
-        self._string_checker('Region', re.compile(r'^[A-Za-z]\d{8}$'))
-        self._known_values_checker('Residence_Type', ['P', 'C'])
-        self._integer_checker('Family_Composition', min = 0, max = 5, include_x = True)
-        self._integer_checker('Sex', min = 1, max = 2)
-        self._integer_checker('Age', min = 1, max = 8)
-        self._integer_checker('Marital_Status', min = 1, max = 5)
-        self._integer_checker('Student', min = 1, max = 2)
-        self._integer_checker('Country_Of_Birth', min = 1, max = 2)
-        self._integer_checker('Health', min = 1, max = 5)
-        self._integer_checker('Ethnic_Group', min = 1, max = 6)
-        self._integer_checker('Religion', min = 1, max = 9)
-        self._integer_checker('Economic_Activity', min = 1, max = 9, include_x = True)
-        self._integer_checker('Occupation', min = 1, max = 9, include_x = True)
-        self._integer_checker('Industry', min = 1, max = 13, include_x = True)
-        self._integer_checker('Hours_Worked_Per_Week', min = 1, max = 4, include_x = True)
-        self._integer_checker('Approximate_Social_Grade', min = 1, max = 4, include_x = True)
+        self.n_checked += len(self.df)
+        checkers = {'integer': self._integer_checker, 'known_values': self._known_values_checker, 'string': self._string_checker}
+        masks = None
+        if self.check_workers != None:
+            with self.report.stage('check columns in parallel', len(self.df)):
+                masks = self._parallel_masks(checkers)
+        # Combine invalid rows of every column into one mask, so rows are only dropped once
+        invalid = np.zeros(len(self.df), dtype = bool)
+        n_valid = len(self.df)
+        for i, (col, checker, kwargs) in enumerate(REFINEMENT_SCHEMA):
+            # Rows in and out of each check are those still valid, although rows are only dropped at the end. Errors are reported
+            # in the same order whether columns were checked here or in parallel
+            with self.report.stage(f'check {col}' if masks is None else f'report {col}', n_valid) as record:
+                err = checkers[checker](self.df[col], **kwargs).to_numpy() if masks is None else masks[i]
+                # Only report rows not already reported for an earlier column
+                new = err & ~invalid
+                if new.any():
+                    self._error_handler(col, self.df.index[new])
+                else:
+                    print(f'All data values in column \'{col}\' match expected data type')
+                invalid |= err
+                n_valid -= int(new.sum())
+                record['rows_out'] = n_valid
+        with self.report.stage('drop invalid rows', len(self.df)) as record:
+            if invalid.any():
+                self.df.drop(index = self.df.index[invalid], inplace = True)
+            # All remaining values are valid, so can be held in compact types
+            self.df = to_typed(self.df)
+            record['rows_out'] = len(self.df)
     
-    def drop_duplicates(self):
+    def _row_fingerprints(self, exclude = []):
+        """ 
+        Method to hash the content of each row into a 64 bit fingerprint, vectorised over the whole frame
+
+        Parameters:
+         - exclude (list): columns not part of a row's content, such as unique keys
+
+        Returns:
+        np.ndarray: uint64 fingerprint of each row
+        """
+        cols = [x for x in self.df.columns if x not in exclude]
+        # Columns have fixed types once refined, so equal rows hash the same in any chunk
+        return pd.util.hash_pandas_object(self.df[cols], index = False).to_numpy()
+
+    def drop_duplicates(self, exclude = None):
         """ 
-        Method to drop rows if duplicated exactly.
+        Method to drop rows if duplicated exactly, apart from the excluded columns. Rows are compared by 64 bit fingerprint rather than value,
+        so a false match is possible but vanishingly unlikely. Rows kept are remembered, so duplicates are also found across chunks.
+
+        Parameters:
+         - exclude (list): columns to ignore when comparing rows, by default duplicate_exclude given to the constructor
         """
+        if exclude is None:
+            exclude = self.duplicate_exclude
         len1 = len(self.df)
-        self.df.drop_duplicates(subset = list(self.df.columns).remove('Record_Number'), inplace = True)
+        with self.report.stage('drop_duplicates', len1) as record:
+            fingerprints = self._row_fingerprints(exclude)
+            dup = pd.Series(fingerprints).duplicated().to_numpy() | self._seen_rows.contains(fingerprints)
+            self.df.drop(index = self.df.index[dup], inplace = True)
+            self._seen_rows.add(fingerprints[~dup])
+            record['rows_out'] = len(self.df)
         len2 = len(self.df)
+        self.n_duplicates += len1 - len2
         # Print statement clarifying whether rows dropped or not
         if len1 - len2 != 0:
             print(f'{len1 - len2} duplicated rows removed')
         else:
             print('No duplicated rows found')
 
+    def _write(self, writer):
+        """ 
+        Method to write refined data with an open RefinedWriter, timing the write
+
+        Parameters:
+         - writer (RefinedWriter): writer to write with
+        """
+        with self.report.stage(f'write_{writer.fmt}', len(self.df)):
+            writer.write(self.df)
+
+    def save(self, output_path, append = False, fmt = None):
+        """ 
+        Method to write refined data, without the index
+
+        Parameters:
+         - output_path (str): filepath to write refined data to
+         - append (bool): if True, add rows to the end of an existing file, without a header
+         - fmt (str): one of OUTPUT_FORMATS, found from the extension of output_path if not given
+        """
+        writer = RefinedWriter(output_path, fmt, append)
+        try:
+            self._write(writer)
+        finally:
+            writer.close()
+
+    def _read_chunks(self, source = None, **kwargs):
+        """ 
+        Method to read the file in chunks, timing each read
+
+        Parameters:
+         - source (file): open file to read from its current position, rather than reading filepath from the start
+         - kwargs: further arguments to pd.read_csv
+
+        Returns:
+        Generator of pd.DataFrame chunks of the file
+        """
+        reader = iter(pd.read_csv(source if source is not None else self.filepath, chunksize = self.chunksize, **kwargs))
+        while True:
+            with self.report.stage('read_csv') as record:
+                chunk = next(reader, None)
+                record['rows_out'] = len(chunk) if chunk is not None else 0
+            if chunk is None:
+                return
+            yield chunk
+
+    def _refine_chunk(self, writer):
+        """ 
+        Method to run the same checks as the in memory route on the current chunk, and write its valid rows
+
+        Parameters:
+         - writer (RefinedWriter): open writer of refined data
+        """
+        self._rename_cols()
+        self.refine_data()
+        self.drop_duplicates()
+        self._write(writer)
+
+    def refine_file(self, output_path, fmt = None):
+        """ 
+        Method to refine a file too large to hold in memory. Reads the file in chunks, runs the same checks as the in memory route on each chunk, and appends valid rows to output_path.
+
+        Parameters:
+         - output_path (str): filepath to write refined data to
+         - fmt (str): one of OUTPUT_FORMATS, found from the extension of output_path if not given
+        """
+        # One writer for all chunks, so compressed and binary formats are written as a single file
+        writer = RefinedWriter(output_path, fmt)
+        try:
+            for chunk in self._read_chunks():
+                self.df = chunk
+                self._refine_chunk(writer)
+        finally:
+            writer.close()
+            self._close_pools()
+
+    def _tail_hash(self, offset, size = 2 ** 16):
+        """ 
+        Method to hash the bytes of the file just before offset, to tell a file appended to from one replaced by another at least as long
+
+        Parameters:
+         - offset (int): byte offset reached by the last run
+         - size (int): number of bytes before offset to hash
+
+        Returns:
+        str: sha256 of the bytes, as hex
+        """
+        with open(self.filepath, 'rb') as f:
+            f.seek(max(offset - size, 0))
+            return hashlib.sha256(f.read(offset - f.tell())).hexdigest()
+
+    def refine_incremental(self, output_path, state_path = None, fmt = None):
+        """ 
+        Method to refine only rows appended to the file since the last run, appending valid rows to output_path. The byte offset reached,
+        number of rows, last Record_Number and a hash of the 64 KiB before the offset are kept in a .json state file, and fingerprints of rows kept
+        in a .npy file alongside it, so duplicates of earlier rows are still found. Refines the whole file if there is no state, or the file was
+        replaced rather than appended to: its header changed, it is shorter than the offset, or the bytes before the offset differ.
+
+        Parameters:
+         - output_path (str): filepath of .csv file to write refined data to
+         - state_path (str): filepath of .json state file, defaults to output_path with '.state.json' in place of '.csv'
+         - fmt (str): one of the .csv OUTPUT_FORMATS, found from the extension of output_path if not given
+        """
+        writer = RefinedWriter(output_path, fmt)
+        if not writer.fmt.startswith('csv'):
+            raise ValueError('Incremental refinement appends to the refined file, so needs a .csv format')
+        state_path = state_path or os.path.splitext(output_path)[0] + '.state.json'
+        fingerprints_path = os.path.splitext(state_path)[0] + '.npy'
+        with open(self.filepath, 'rb') as f:
+            header = f.readline()
+        state = None
+        if os.path.exists(state_path) and os.path.exists(output_path) and os.path.exists(fingerprints_path):
+            with open(state_path) as f:
+                state = json.load(f)
+            # Earlier rows can't be trusted if the file is shorter, its columns differ, or the bytes already refined changed
+            if state['header'] != header.decode() or os.path.getsize(self.filepath) < state['offset'] or state.get('tail_sha256') != self._tail_hash(state['offset']):
+                print('File changed since last run, refining from the start')
+                state = None
+            # Fingerprints of earlier rows only match new ones if the same columns are compared
+            elif state.get('duplicate_exclude', []) != self.duplicate_exclude:
+                print('Columns compared to find duplicates changed since last run, refining from the start')
+                state = None
+        if state is None:
+            state = {'offset': len(header), 'n_rows': 0, 'last_record_number': None, 'header': header.decode(), 'duplicate_exclude': self.duplicate_exclude}
+            self._seen_rows = FingerprintSet()
+            append = False
+        else:
+            self._seen_rows.load(fingerprints_path)
+            append = True
+        if os.path.getsize(self.filepath) == state['offset']:
+            print('No new records to refine')
+            return
+        print(f'Refining records from row {state["n_rows"] + 1}')
+        names = pd.read_csv(self.filepath, nrows = 0).columns
+        n_rows = state['n_rows']
+        writer = RefinedWriter(output_path, writer.fmt, append)
+        try:
+            with open(self.filepath, 'rb') as f:
+                f.seek(state['offset'])
+                for chunk in self._read_chunks(f, header = None, names = names):
+                    # Chunks are numbered from the offset, so number rows by position in the whole file as refining it all at once would
+                    chunk.index += n_rows
+                    state['n_rows'] += len(chunk)
+                    self.df = chunk
+                    self._refine_chunk(writer)
+                    if len(self.df) > 0:
+                        state['last_record_number'] = int(self.df['Record_Number'].iloc[-1])
+                state['offset'] = f.tell()
+            state['tail_sha256'] = self._tail_hash(state['offset'])
+        finally:
+            writer.close()
+            self._close_pools()
+        # Fingerprints saved first, so state only moves on once everything it refers to is written
+        self._seen_rows.save(fingerprints_path)
+        with open(state_path, 'w') as f:
+            json.dump(state, f, indent = 2)
+
+def refine_path(filepath, chunksize = None, trace_memory = False, incremental = False, output_path = None, output_format = 'csv', check_workers = None, duplicate_exclude = []):
+    """ 
+    Function to refine one file, by default saving it alongside the original with '_refined' appended
+
+    Parameters:
+     - filepath (str): filepath of .csv file to refine
+     - chunksize (int): if given, stream the file in chunks of this many rows
+     - trace_memory (bool): if True, record peak memory of each stage in the report
+     - incremental (bool): if True, only refine rows appended since the last incremental run, streamed in chunks of chunksize rows (100000 if not given)
+     - output_path (str): filepath to save refined data to, defaults to filepath with '_refined' and the extension of output_format
+     - output_format (str): one of OUTPUT_FORMATS
+     - check_workers (int): if given, check all columns at once with this many threads and processes
+     - duplicate_exclude (list): columns to ignore when finding duplicate rows
+
+    Returns:
+    dict: filepath, output filepath, rows checked, invalid rows per column, duplicated rows, rows kept and stage report
+    """
+    report = StageReport(trace_memory = trace_memory)
+    output_path = output_path or filepath[:-4] + '_refined' + OUTPUT_FORMATS[output_format]
+    if incremental:
+        # Streaming route over new rows only
+        dl = DataLoader(filepath, chunksize = chunksize or 100000, report = report, check_workers = check_workers, duplicate_exclude = duplicate_exclude)
+        dl.refine_incremental(output_path, fmt = output_format)
+    elif chunksize is not None:
+        # Streaming route, memory use bounded by chunksize
+        dl = DataLoader(filepath, chunksize = chunksize, report = report, check_workers = check_workers, duplicate_exclude = duplicate_exclude)
+        print('Refining data in chunks and saving refined data')
+        dl.refine_file(output_path, output_format)
+    else:
+        dl = DataLoader(filepath, report = report, check_workers = check_workers, duplicate_exclude = duplicate_exclude)
+        dl._rename_cols()
+        dl.refine_data()
+        dl.drop_duplicates()
+        print('Saving refined data')
+        dl.save(output_path, fmt = output_format)
+        # Binary copy of refined data, read by DataDescriber and DataPlotter while it matches the .csv
+        if output_format.startswith('csv'):
+            with report.stage('write_cache', len(dl.df)):
+                write_cache(dl.df, output_path)
+    n_kept = dl.n_checked - sum(dl.error_counts.values()) - dl.n_duplicates
+    return {'filepath': filepath, 'output_path': output_path, 'n_checked': dl.n_checked, 'error_counts': dl.error_counts,
+            'n_duplicates': dl.n_duplicates, 'n_kept': n_kept, 'report': report.to_dict()}
+
+def refine_captured(filepath, *args):
+    """ 
+    Function to refine one of several files in parallel. Output printed while refining is captured rather than shown, so files don't
+    interleave, and an error is returned rather than raised, so one failing file doesn't stop the rest. See refine_path for parameters
+
+    Returns:
+    dict: as refine_path with the captured log added, or filepath, error and captured log if refining failed
+    """
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            result = refine_path(filepath, *args)
+    except Exception as e:
+        log.write(traceback.format_exc())
+        return {'filepath': filepath, 'error': f'{type(e).__name__}: {e}', 'log': log.getvalue()}
+    result['log'] = log.getvalue()
+    return result
+
+def merge_refined(paths, output_path, chunksize = 100000):
+    """ 
+    Function to concatenate refined files into one, in the format given by the extension of output_path
+
+    Parameters:
+     - paths (list): filepaths of refined files, in order to merge
+     - output_path (str): filepath of merged file
+     - chunksize (int): number of rows to read at a time, so memory stays bounded
+    """
+    writer = RefinedWriter(output_path)
+    try:
+        for path in paths:
+            for chunk in iter_refined(path, chunksize):
+                writer.write(chunk)
+    finally:
+        writer.close()
+
+def expand_paths(patterns):
+    """ 
+    Function to expand filepaths and glob patterns into a list of files to refine. Refined outputs of any format matched by a pattern are skipped.
+
+    Parameters:
+     - patterns (list): filepaths or glob patterns
+
+    Returns:
+    list: filepaths to refine, in order given
+    """
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            raise FileNotFoundError(f'No files match \'{pattern}\'')
+        paths.extend(x for x in matches if not os.path.basename(x).split('.')[0].endswith('_refined') and x not in paths)
+    return paths
+
+def print_summary(results):
+    """ 
+    Function to print the refinement summary of several files as one table, followed by invalid rows per column
+
+    Parameters:
+     - results (list): dicts returned by refine_captured
+    """
+    failed = [x for x in results if 'error' in x]
+    results = [x for x in results if 'error' not in x]
+    width = max(len(os.path.basename(x['filepath'])) for x in results + failed)
+    print(f'{"File":<{width}}  {"Checked":>10}  {"Invalid":>10}  {"Duplicates":>10}  {"Kept":>10}')
+    for x in results:
+        print(f'{os.path.basename(x["filepath"]):<{width}}  {x["n_checked"]:>10}  {sum(x["error_counts"].values()):>10}  {x["n_duplicates"]:>10}  {x["n_kept"]:>10}')
+    totals = {}
+    for x in results:
+        for col, n in x['error_counts'].items():
+            totals[col] = totals.get(col, 0) + n
+    print(f'{"Total":<{width}}  {sum(x["n_checked"] for x in results):>10}  {sum(totals.values()):>10}  '
+          f'{sum(x["n_duplicates"] for x in results):>10}  {sum(x["n_kept"] for x in results):>10}')
+    if len(totals) > 0:
+        print('Invalid records by column:')
+        for col, n in totals.items():
+            print(f' - {col}: {n}')
+    if len(failed) > 0:
+        print(f'{len(failed)} files could not be refined:')
+        for x in failed:
+            print(f' - {os.path.basename(x["filepath"])}: {x["error"]}')
+
 # If code ran from terminal, cover all relevant data analysis steps. See data_refinement.bat for command line prompt
 if __name__ == '__main__':
     # Create argument parser
     parser = argparse.ArgumentParser()
-    parser.add_argument("filepath", type=str, help="Filepath")
+    parser.add_argument("filepath", type=str, nargs="+", help="Filepaths or glob patterns of files to refine")
+    parser.add_argument("--chunksize", type=int, default=None, help="Stream the file in chunks of this many rows rather than loading it all into memory")
+    parser.add_argument("--workers", type=int, default=None, help="Number of files to refine in parallel, defaults to number of CPUs")
+    parser.add_argument("--merged", type=str, default=None, help="Filepath to merge refined files into when refining several, defaults to 'merged_refined' alongside the first")
+    parser.add_argument("--output", type=str, default=None, help="Filepath to save refined data to when refining one file, defaults to the file with '_refined' appended")
+    parser.add_argument("--output-format", type=str, default="csv", choices=list(OUTPUT_FORMATS), help="Format to save refined data in. Compressed and binary formats need pyarrow, apart from csv.gz")
+    parser.add_argument("--report-json", type=str, default=None, help="Filepath to save time, rows and memory of each stage to as JSON")
+    parser.add_argument("--trace-memory", action="store_true", help="Record peak memory of each stage in the report, slows refinement down")
+    parser.add_argument("--check-workers", type=int, default=None, help="Check all columns at once with this many threads and processes, rather than one after another")
+    parser.add_argument("--duplicate-exclude", type=str, nargs="+", default=[], help="Columns to ignore when finding duplicate rows, e.g. Record_Number. By default rows must match in every column")
+    parser.add_argument("--incremental", action="store_true", help="Only refine rows appended since the last incremental run, adding them to the refined file")
     args = parser.parse_args()
-    dl = DataLoader(args.filepath)
-    dl._rename_cols()
-    dl.refine_data()
-    dl.drop_duplicates()
-    print('Saving refined data')
-    dl.df.to_csv(args.filepath[:-4] + '_refined.csv')
\ No newline at end of file
+    paths = expand_paths(args.filepath)
+    if args.output != None and len(paths) > 1:
+        parser.error('--output can only be used when refining one file, use --merged for several')
+    if len(paths) == 1:
+        # Single file, refine here and print as it goes
+        results = [refine_path(paths[0], args.chunksize, args.trace_memory, args.incremental, args.output, args.output_format, args.check_workers, args.duplicate_exclude)]
+    else:
+        print(f'Refining {len(paths)} files')
+        with ProcessPoolExecutor(max_workers = args.workers) as executor:
+            results = list(executor.map(refine_captured, paths, [args.chunksize] * len(paths), [args.trace_memory] * len(paths), [args.incremental] * len(paths), [None] * len(paths), [args.output_format] * len(paths), [args.check_workers] * len(paths), [args.duplicate_exclude] * len(paths)))
+        # Print each file's log in one block, then a summary of them all
+        for result in results:
+            print(f'===== {result["filepath"]} =====')
+            print(result['log'], end = '')
+        print_summary(results)
+        # Only files refined without error are merged
+        refined = [x['output_path'] for x in results if 'error' not in x]
+        if len(refined) > 0:
+            merged = args.merged or os.path.join(os.path.dirname(paths[0]), 'merged_refined' + OUTPUT_FORMATS[args.output_format])
+            print(f'Merging refined data into {merged}')
+            merge_refined(refined, merged)
+    if args.report_json != None:
+        with open(args.report_json, 'w') as f:
+            json.dump({x['filepath']: x['report'] for x in results if 'error' not in x}, f, indent = 2)
+    if any('error' in x for x in results):
+        sys.exit(1)
@@ -0,0 +1 @@
+python .\code\data_report.py .\data\Scotland_teaching_file_1PCT_refined.csv --output-dir .\report --formats png svg
\ No newline at end of file
@@ -0,0 +1,134 @@
+## code to render every bar chart, pie chart and heatmap of refined data to image files with an index page, without Jupyter. Can be called from terminal, see data_report.bat
+
+import argparse
+import html
+import os
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+# Render off screen, before pyplot is imported by the plotting modules
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from data_aggregation import build_cube
+from data_description import grouped_frame, plot_heatmap
+from data_plotting import plot_bar_chart, plot_pie_chart
+
+# Counts shared with each worker process, set once by _init_worker rather than sent with every chart
+_cube = None
+_output_dir = None
+_formats = None
+
+def chart_tasks(columns):
+    """
+    Lists every chart to render: a bar and pie chart of each column, and a heatmap of each pair of columns. Heatmaps of
+    a pair in reverse order are the same heatmap transposed, so only one order is rendered.
+
+    Parameters:
+    - columns (List[str]): categorical columns to chart.
+
+    Returns:
+    List[tuple]: kind of chart and columns to chart.
+    """
+    tasks = [('bar', col) for col in columns] + [('pie', col) for col in columns]
+    for i, col1 in enumerate(columns):
+        for col2 in columns[i + 1:]:
+            tasks.append(('heatmap', col1, col2))
+    return tasks
+
+def _init_worker(cube, output_dir, formats):
+    """
+    Stores the counts and output settings in a worker process, so they are sent to each worker once.
+    """
+    global _cube, _output_dir, _formats
+    _cube = cube
+    _output_dir = output_dir
+    _formats = formats
+
+def render(task, explode_val = 0.25, explode_max = 0.05):
+    """
+    Draws one chart from the shared counts and saves it in each format.
+
+    Parameters:
+    - task (tuple): kind of chart and columns to chart, as from chart_tasks.
+    - explode_val (float [0, inf)): how much to explode small values of pie charts, as the pie_chart widget default.
+    - explode_max (float [0, 1]): max percentage to explode in pie charts, as the pie_chart widget default.
+
+    Returns:
+    str: file name of chart, without extension.
+    """
+    kind, cols = task[0], task[1:]
+    name = '_'.join((kind,) + cols)
+    if kind == 'heatmap':
+        fig = plot_heatmap(*grouped_frame(_cube, *cols))
+    else:
+        counts = _cube.frequencies(cols[0])
+        # Cube counts every category, so drop those not present as the widgets do
+        counts = counts[counts > 0]
+        if kind == 'bar':
+            fig = plot_bar_chart(counts, cols[0])
+        else:
+            fig = plot_pie_chart(counts, cols[0], explode_val, explode_max)
+    for fmt in _formats:
+        fig.savefig(os.path.join(_output_dir, f'{name}.{fmt}'), format = fmt, bbox_inches = 'tight')
+    plt.close(fig)
+    return name
+
+def write_index(output_dir, tasks, names, formats):
+    """
+    Writes index.html showing every chart, grouped by kind.
+
+    Parameters:
+    - output_dir (str): folder charts were saved to.
+    - tasks (List[tuple]): charts rendered, as from chart_tasks.
+    - names (List[str]): file name of each chart, without extension.
+    - formats (List[str]): formats charts were saved in, the first is shown.
+    """
+    titles = {'bar': 'Bar charts', 'pie': 'Pie charts', 'heatmap': 'Heatmaps'}
+    lines = ['<!DOCTYPE html>', '<html>', '<head><meta charset="utf-8"><title>Data report</title></head>', '<body>', '<h1>Data report</h1>']
+    for kind, title in titles.items():
+        lines.append(f'<h2>{title}</h2>')
+        for task, name in zip(tasks, names):
+            if task[0] == kind:
+                caption = html.escape(' by '.join(task[1:]))
+                lines.append(f'<figure><img src="{html.escape(name)}.{formats[0]}" alt="{caption}"><figcaption>{caption}</figcaption></figure>')
+    lines += ['</body>', '</html>']
+    with open(os.path.join(output_dir, 'index.html'), 'w', encoding = 'utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def render_report(filepath, output_dir, formats = ['png'], workers = None, chunksize = None, weight = None, scale = 1):
+    """
+    Renders every chart of refined data in parallel, and writes an index page linking them.
+
+    Parameters:
+    - filepath (str): filepath where refined .csv data is found.
+    - output_dir (str): folder to save charts and index.html to, created if needed.
+    - formats (List[str]): image formats to save each chart in, e.g. png and svg.
+    - workers (int): number of charts to render in parallel, defaults to number of CPUs.
+    - chunksize (int): if given, read the data in chunks of this many rows, for files larger than memory.
+    - weight (str): column giving the weight of each record, if records are weighted.
+    - scale (int, float): number counts are multiplied by to estimate the population.
+
+    Returns:
+    List[str]: file name of each chart, without extension.
+    """
+    os.makedirs(output_dir, exist_ok = True)
+    cube = build_cube(filepath, chunksize, weight, scale)[0]
+    tasks = chart_tasks(cube.columns)
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (cube, output_dir, formats)) as executor:
+        # Send charts in batches, as each is quick to draw compared to a round trip to a worker
+        names = list(executor.map(render, tasks, chunksize = max(1, len(tasks) // (4 * (workers or os.cpu_count() or 1)))))
+    write_index(output_dir, tasks, names, formats)
+    return names
+
+# If code ran from terminal, render report. See data_report.bat for command line prompt
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filepath", type=str, help="Filepath of refined .csv data")
+    parser.add_argument("--output-dir", type=str, default="report", help="Folder to save charts and index.html to")
+    parser.add_argument("--formats", type=str, nargs="+", default=["png"], choices=["png", "svg"], help="Image formats to save each chart in")
+    parser.add_argument("--workers", type=int, default=None, help="Number of charts to render in parallel, defaults to number of CPUs")
+    parser.add_argument("--chunksize", type=int, default=None, help="Read the data in chunks of this many rows rather than loading it all into memory")
+    parser.add_argument("--weight", type=str, default=None, help="Column giving the weight of each record, charts show summed weights rather than numbers of records")
+    parser.add_argument("--scale", type=float, default=1, help="Number counts are multiplied by to estimate the population, e.g. 100 for a 1%% sample")
+    args = parser.parse_args()
+    names = render_report(args.filepath, args.output_dir, args.formats, args.workers, args.chunksize, args.weight, args.scale)
+    print(f'Rendered {len(names)} charts to {os.path.join(args.output_dir, "index.html")}')
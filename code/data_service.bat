@@ -0,0 +1 @@
+python .\code\data_service.py .\data\Scotland_teaching_file_1PCT_refined.csv --port 8765
\ No newline at end of file
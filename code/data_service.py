@@ -0,0 +1,262 @@
+## code to serve counts of refined data over HTTP on this machine, so many notebooks can share one copy of the data rather than each reading and counting it. Can be called from terminal, see data_service.bat
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlencode, urlparse
+from urllib.request import urlopen
+import pandas as pd
+from data_aggregation import build_cube
+from data_cache import LRUCache
+from data_description import grouped_frame
+
+class AggregationService:
+    """
+    This class counts refined data once and answers the queries behind the heatmaps, bar charts and pie charts of DataDescriber
+    and DataPlotter. Answers are cached, so a query asked by one notebook is instant for the rest.
+    """
+    QUERIES = ['/info', '/frequencies', '/grouped', '/stats']
+
+    def __init__(self, filepath, chunksize = None, weight = None, scale = 1, cache_size = 1024, cache_max_bytes = 64 * 2 ** 20):
+        """
+        Constructor for AggregationService.
+
+        Parameters:
+        - filepath (str): filepath where refined data is found, in any of OUTPUT_FORMATS.
+        - chunksize (int): if given, read the data in chunks of this many rows, for files larger than memory.
+        - weight (str): column giving the weight of each record, if records are weighted.
+        - scale (int, float): number counts are multiplied by to estimate the population.
+        - cache_size (int): maximum number of answers to cache.
+        - cache_max_bytes (int): maximum memory used by the cache, in bytes.
+        """
+        self.cube, self.dtypes = build_cube(filepath, chunksize, weight, scale)
+        self.weight = weight
+        self.cache = LRUCache(cache_size, cache_max_bytes)
+        # Requests are answered in threads. The counts are only read, but the cache is changed by every lookup
+        self._lock = threading.Lock()
+
+    def _info(self, params):
+        """
+        Gets the columns of the data and the number of records.
+        """
+        return {'columns': list(self.dtypes.index), 'dtypes': [str(x) for x in self.dtypes], 'n_records': self.cube.n_records,
+                'total': self.cube.total(), 'weighted': self.cube.weighted, 'weight': self.weight, 'scale': self.cube.scale}
+
+    def _frequencies(self, params):
+        """
+        Gets the number of records taking each value of the column 'col', including values with no records.
+        """
+        counts = self.cube.frequencies(params['col'])
+        return {'values': counts.index.tolist(), 'counts': counts.tolist()}
+
+    def _grouped(self, params):
+        """
+        Gets the number or proportion of records for each pair of values of columns 'col1' and 'col2', as grouped_frame. Selected
+        values are given as JSON lists.
+        """
+        col1_vals = json.loads(params['col1_vals']) if 'col1_vals' in params else 'None'
+        col2_vals = json.loads(params['col2_vals']) if 'col2_vals' in params else 'None'
+        grouped_df, fmt, cmap = grouped_frame(self.cube, params['col1'], params['col2'], col1_vals, col2_vals,
+                                              params.get('summary_stats', 'None'), params.get('proportional', 'Count'))
+        return {'index': grouped_df.index.tolist(), 'index_name': grouped_df.index.name, 'columns': grouped_df.columns.tolist(),
+                'columns_name': grouped_df.columns.name, 'data': grouped_df.to_numpy().tolist(), 'fmt': fmt, 'cmap': cmap}
+
+    def _stats(self, params):
+        """
+        Gets usage statistics of the cache.
+        """
+        with self._lock:
+            return self.cache.stats()
+
+    def query(self, path, params):
+        """
+        Answers a query, from the cache if it has been asked before.
+
+        Parameters:
+        - path (str): query to answer, one of QUERIES.
+        - params (dict): parameters of query.
+
+        Returns:
+        bytes: answer as JSON.
+        """
+        handlers = {'/info': self._info, '/frequencies': self._frequencies, '/grouped': self._grouped, '/stats': self._stats}
+        if path == '/stats':
+            return json.dumps(self._stats(params)).encode()
+        key = (path,) + tuple(sorted(params.items()))
+        with self._lock:
+            body = self.cache.get(key)
+        if body is None:
+            body = json.dumps(handlers[path](params)).encode()
+            with self._lock:
+                self.cache.put(key, body)
+        return body
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    This class answers each HTTP request with the AggregationService of its server.
+    """
+    def do_GET(self):
+        """
+        Answers a GET request with JSON. Unknown queries get 404, and bad parameters, such as a column that isn't in the data, get 400.
+        """
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path not in AggregationService.QUERIES:
+            body, status = json.dumps({'error': f'Unknown query {url.path}'}).encode(), 404
+        else:
+            try:
+                body, status = self.server.service.query(url.path, params), 200
+            except Exception as e:
+                body, status = json.dumps({'error': f'{type(e).__name__}: {e}'}).encode(), 400
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(filepath, host = '127.0.0.1', port = 8765, chunksize = None, weight = None, scale = 1, cache_size = 1024, cache_max_bytes = 64 * 2 ** 20):
+    """
+    Counts refined data and answers queries until interrupted.
+
+    Parameters:
+    - filepath (str): filepath where refined data is found, in any of OUTPUT_FORMATS.
+    - host (str): address to listen on. Defaults to this machine only.
+    - port (int): port to listen on.
+    - chunksize (int): if given, read the data in chunks of this many rows, for files larger than memory.
+    - weight (str): column giving the weight of each record, if records are weighted.
+    - scale (int, float): number counts are multiplied by to estimate the population.
+    - cache_size (int): maximum number of answers to cache.
+    - cache_max_bytes (int): maximum memory used by the cache, in bytes.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.service = AggregationService(filepath, chunksize, weight, scale, cache_size, cache_max_bytes)
+    print(f'Serving {filepath} at http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+class ServiceClient:
+    """
+    This class queries an AggregationService. It takes the place of the ContingencyCube of DataDescriber and DataPlotter, so
+    they don't read or count the data themselves.
+    """
+    def __init__(self, url, timeout = 30):
+        """
+        Constructor for ServiceClient. Gets the columns of the data and the number of records.
+
+        Parameters:
+        - url (str): address of service, e.g. 'http://localhost:8765'.
+        - timeout (float): seconds to wait for each answer.
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        info = self._get('/info')
+        self.columns = pd.Index(info['columns'])
+        self.dtypes = pd.Series(info['dtypes'], index = self.columns)
+        self.n_records = info['n_records']
+        self.weighted = info['weighted']
+        self.weight = info['weight']
+        self.scale = info['scale']
+        self._total = info['total']
+
+    def _get(self, path, **params):
+        """
+        Sends a query to the service.
+
+        Parameters:
+        - path (str): query to send.
+        - params: parameters of query.
+
+        Returns:
+        dict: answer.
+        """
+        try:
+            with urlopen(f'{self.url}{path}?{urlencode(params)}', timeout = self.timeout) as response:
+                return json.loads(response.read())
+        except HTTPError as e:
+            # Raise the error the service hit, rather than only its status
+            raise ValueError(json.loads(e.read())['error']) from None
+
+    def _values(self, vals):
+        """
+        Encodes a selection of values from a widget as JSON, sorted so the same selection in any order is cached once by the service.
+
+        Parameters:
+        - vals (List[str] or str): selected values, or 'None'.
+
+        Returns:
+        str: JSON list of values, or 'None'.
+        """
+        if isinstance(vals, str):
+            return vals
+        # Values from numpy, such as the categories of a column, aren't JSON types
+        return json.dumps(sorted(set(x.item() if hasattr(x, 'item') else x for x in vals), key = str))
+
+    def total(self):
+        """
+        Gets the total of all counts, the number of records if not weighted or scaled.
+
+        Returns:
+        int, float: total weighted and scaled count.
+        """
+        return self._total
+
+    def frequencies(self, col):
+        """
+        Gets the number of records taking each value of a column, including values with no records.
+
+        Parameters:
+        - col (str): column to count values of.
+
+        Returns:
+        pd.Series: number of records, indexed by values of col.
+        """
+        answer = self._get('/frequencies', col = col)
+        return pd.Series(answer['counts'], index = pd.Index(answer['values'], name = col), name = 'count')
+
+    def grouped_frame(self, col1, col2, col1_vals = 'None', col2_vals = 'None', summary_stats = 'None', proportional = 'Count'):
+        """
+        Gets the number or proportion of records for each pair of values of two columns. See grouped_frame for parameters.
+
+        Returns:
+        pd.DataFrame: number or proportion of records for each group.
+        str: format of heatmap annotations.
+        str: colour map of heatmap.
+        """
+        params = {'col1': col1, 'col2': col2, 'summary_stats': summary_stats, 'proportional': proportional}
+        if not isinstance(col1_vals, str):
+            params['col1_vals'] = self._values(col1_vals)
+        if not isinstance(col2_vals, str):
+            params['col2_vals'] = self._values(col2_vals)
+        answer = self._get('/grouped', **params)
+        grouped_df = pd.DataFrame(answer['data'], index = pd.Index(answer['index'], name = answer['index_name']),
+                                  columns = pd.Index(answer['columns'], name = answer['columns_name']))
+        return grouped_df, answer['fmt'], answer['cmap']
+
+    def stats(self):
+        """
+        Gets usage statistics of the service's cache, shared by every notebook using it.
+
+        Returns:
+        dict: hits, misses, hit rate, number of entries and total bytes stored.
+        """
+        return self._get('/stats')
+
+# If code ran from terminal, serve counts of the given file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("filepath", type=str, help="Filepath of refined data")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on, defaults to this machine only")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--chunksize", type=int, default=None, help="Read the data in chunks of this many rows rather than loading it all into memory")
+    parser.add_argument("--weight", type=str, default=None, help="Column giving the weight of each record, counts are summed weights rather than numbers of records")
+    parser.add_argument("--scale", type=float, default=1, help="Number counts are multiplied by to estimate the population, e.g. 100 for a 1%% sample")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Maximum number of answers to cache")
+    parser.add_argument("--cache-max-mb", type=float, default=64, help="Maximum memory used by the cache, in MB")
+    args = parser.parse_args()
+    serve(args.filepath, args.host, args.port, args.chunksize, args.weight, args.scale, args.cache_size, int(args.cache_max_mb * 2 ** 20))
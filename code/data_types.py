@@ -0,0 +1,364 @@
+## code defining the expected values of each column, and the compact data types used to hold them in memory. Shared by DataLoader, DataDescriber and DataPlotter
+
+import hashlib
+import json
+import os
+import pandas as pd
+# pyarrow is optional, only needed for the binary cache of refined data and for writing formats other than .csv and .csv.gz
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    from pyarrow import feather
+    from pyarrow import parquet as pq
+except ImportError:
+    pa = None
+    feather = None
+
+# Helper file describing each column and its values, found relative to this file so it resolves from any working directory
+VARIABLE_LIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'Teaching_File_Variable_List.xlsx')
+
+# Formats refined data can be written in, and the file extension of each
+OUTPUT_FORMATS = {'csv': '.csv', 'csv.gz': '.csv.gz', 'csv.zst': '.csv.zst', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Expected values of each column, as defined in 'Teaching_File_Variable_List.xlsx'. Each entry is (column, checker, checker arguments)
+REFINEMENT_SCHEMA = [
+    ('Record_Number', 'integer', {'min': 1}),
+    ('Region', 'string', {'regex': r'[A-Za-z]\d{8}'}),
+    ('Residence_Type', 'known_values', {'vals': ['P', 'C']}),
+    ('Family_Composition', 'integer', {'min': 0, 'max': 5, 'include_x': True}),
+    ('Sex', 'integer', {'min': 1, 'max': 2}),
+    ('Age', 'integer', {'min': 1, 'max': 8}),
+    ('Marital_Status', 'integer', {'min': 1, 'max': 5}),
+    ('Student', 'integer', {'min': 1, 'max': 2}),
+    ('Country_Of_Birth', 'integer', {'min': 1, 'max': 2}),
+    ('Health', 'integer', {'min': 1, 'max': 5}),
+    ('Ethnic_Group', 'integer', {'min': 1, 'max': 6}),
+    ('Religion', 'integer', {'min': 1, 'max': 9}),
+    ('Economic_Activity', 'integer', {'min': 1, 'max': 9, 'include_x': True}),
+    ('Occupation', 'integer', {'min': 1, 'max': 9, 'include_x': True}),
+    ('Industry', 'integer', {'min': 1, 'max': 13, 'include_x': True}),
+    ('Hours_Worked_Per_Week', 'integer', {'min': 1, 'max': 4, 'include_x': True}),
+    ('Approximate_Social_Grade', 'integer', {'min': 1, 'max': 4, 'include_x': True}),
+]
+
+def _column_dtypes(schema):
+    """
+    Builds the in memory data type of each column from its expected values.
+
+    Coded columns become ordered categoricals, which are stored as int8 codes. Columns that allow 'X' keep their
+    values as strings (as they are written in the .csv), with 'X' always the last category, so it has a fixed
+    sentinel code after the numeric codes.
+
+    Parameters:
+    - schema (list): list of (column, checker, checker arguments) as in REFINEMENT_SCHEMA.
+
+    Returns:
+    dict: data type of each column.
+    """
+    dtypes = {}
+    for col, checker, kwargs in schema:
+        if checker == 'integer' and kwargs.get('max') != None:
+            vals = list(range(kwargs.get('min', 0), kwargs['max'] + 1))
+            if kwargs.get('include_x') == True:
+                vals = [str(x) for x in vals] + ['X']
+            dtypes[col] = pd.CategoricalDtype(vals, ordered = True)
+        elif checker == 'known_values':
+            dtypes[col] = pd.CategoricalDtype(sorted(kwargs['vals']))
+        elif checker == 'string':
+            dtypes[col] = 'category'
+        else:
+            dtypes[col] = 'int64'
+    return dtypes
+
+COLUMN_DTYPES = _column_dtypes(REFINEMENT_SCHEMA)
+
+def to_typed(df):
+    """
+    Converts columns of a refined DataFrame to their compact data types. Values not allowed by REFINEMENT_SCHEMA
+    would become missing, so data should be refined first.
+
+    Parameters:
+    - df (pd.DataFrame): refined data, columns as read from .csv.
+
+    Returns:
+    pd.DataFrame: df, with columns converted in place.
+    """
+    for col, dtype in COLUMN_DTYPES.items():
+        if col not in df.columns:
+            continue
+        data = df[col]
+        if pd.api.types.is_float_dtype(data):
+            # Integers are read as floats if the column had blanks, since dropped. Made integers again so 13.0 is matched as '13'
+            data = data.astype('Int64')
+        if isinstance(dtype, pd.CategoricalDtype) and not (pd.api.types.is_numeric_dtype(data) and pd.api.types.is_numeric_dtype(dtype.categories)):
+            # Match values by their text, as a column is read as integers or strings depending on whether it contains 'X'
+            text_dtype = pd.CategoricalDtype([str(x) for x in dtype.categories])
+            codes = data.astype(str).astype(text_dtype).cat.codes
+            df[col] = pd.Categorical.from_codes(codes, dtype = dtype)
+        else:
+            df[col] = data.astype(dtype)
+    return df
+
+def read_typed_csv(filepath, **kwargs):
+    """
+    Reads refined .csv data straight into compact data types, without building int64 or object columns first.
+
+    Parameters:
+    - filepath (str): filepath where refined .csv data is found.
+    - **kwargs: further arguments passed to pd.read_csv.
+
+    Returns:
+    pd.DataFrame: data read in.
+    """
+    return pd.read_csv(filepath, dtype = COLUMN_DTYPES, **kwargs)
+
+def _cache_path(filepath):
+    """
+    Gets filepath of the binary cache for a refined .csv file, stored alongside it. Compressed .csv files keep their
+    extension, so caches of the same data in different formats don't overwrite each other.
+    """
+    if output_format(filepath) != 'csv':
+        return filepath + '.feather'
+    return os.path.splitext(filepath)[0] + '.feather'
+
+def _source_stamp(filepath):
+    """
+    Gets a stamp of the size and modification time of a file, used to tell if a cache was built from it.
+    """
+    stat = os.stat(filepath)
+    return f'{stat.st_size}:{stat.st_mtime_ns}'.encode()
+
+def write_cache(df, filepath):
+    """
+    Writes refined data to an uncompressed Feather (Arrow IPC) file next to its .csv, keeping data types, so it can
+    be memory mapped and read without parsing text. Does nothing if pyarrow is not installed.
+
+    Parameters:
+    - df (pd.DataFrame): refined data, as written to filepath.
+    - filepath (str): filepath of refined .csv, must be written before the cache.
+    """
+    if feather == None:
+        return
+    table = pa.Table.from_pandas(df, preserve_index = False)
+    # Record which version of the .csv the cache was built from
+    metadata = {**table.schema.metadata, b'source_stamp': _source_stamp(filepath)}
+    feather.write_feather(table.replace_schema_metadata(metadata), _cache_path(filepath), compression = 'uncompressed')
+
+def output_format(filepath):
+    """
+    Gets the format of a refined data file from its extension, one of OUTPUT_FORMATS.
+
+    Parameters:
+    - filepath (str): filepath of refined data.
+
+    Returns:
+    str: format of file, 'csv' if the extension is not recognised.
+    """
+    # Check longest extensions first, so '.csv.gz' isn't taken as '.gz'
+    for fmt, ext in sorted(OUTPUT_FORMATS.items(), key = lambda x: -len(x[1])):
+        if filepath.endswith(ext):
+            return fmt
+    return 'csv'
+
+def _csv_source(filepath):
+    """
+    Gets something pd.read_csv can read a refined .csv from. pandas needs an extra package for zstd, so .csv.zst is decompressed by pyarrow.
+    """
+    if output_format(filepath) == 'csv.zst' and pa != None:
+        return pa.input_stream(filepath, compression = 'zstd')
+    return filepath
+
+def _index_col(filepath):
+    """
+    Gets the index column of a refined .csv. Files written before the index was left out start with an unnamed index column.
+    """
+    first = pd.read_csv(_csv_source(filepath), nrows = 0).columns[0]
+    return 0 if first.startswith('Unnamed') else None
+
+def _apply_dtypes(df):
+    """
+    Converts columns read from a binary format to their compact data types, as types are lost when reading part of a file.
+    """
+    return df.astype({col: dtype for col, dtype in COLUMN_DTYPES.items() if col in df.columns and df[col].dtype != dtype})
+
+def read_refined(filepath):
+    """
+    Reads refined data in any of OUTPUT_FORMATS. For .csv, uses the binary cache if it was built from the current
+    version of the .csv, else falls back to reading the .csv.
+
+    Parameters:
+    - filepath (str): filepath where refined data is found.
+
+    Returns:
+    pd.DataFrame: data read in.
+    """
+    fmt = output_format(filepath)
+    if fmt == 'parquet':
+        return _apply_dtypes(pd.read_parquet(filepath))
+    if fmt == 'arrow':
+        # Memory mapped, so columns are used in place rather than copied into memory where possible
+        return _apply_dtypes(feather.read_table(filepath, memory_map = True).to_pandas())
+    cache = _cache_path(filepath)
+    if feather != None and os.path.exists(cache):
+        table = feather.read_table(cache, memory_map = True)
+        if table.schema.metadata.get(b'source_stamp') == _source_stamp(filepath):
+            return table.to_pandas()
+    return read_typed_csv(_csv_source(filepath), index_col = _index_col(filepath))
+
+def iter_refined(filepath, chunksize):
+    """
+    Reads refined data in any of OUTPUT_FORMATS a chunk at a time, for files too large to hold in memory.
+
+    Parameters:
+    - filepath (str): filepath where refined data is found.
+    - chunksize (int): number of rows in each chunk.
+
+    Returns:
+    Generator of pd.DataFrame chunks of the data.
+    """
+    fmt = output_format(filepath)
+    if fmt == 'parquet':
+        for batch in pq.ParquetFile(filepath).iter_batches(batch_size = chunksize):
+            yield _apply_dtypes(batch.to_pandas())
+    elif fmt == 'arrow':
+        table = feather.read_table(filepath, memory_map = True)
+        for batch in table.to_batches(max_chunksize = chunksize):
+            yield _apply_dtypes(batch.to_pandas())
+    else:
+        yield from read_typed_csv(_csv_source(filepath), index_col = _index_col(filepath), chunksize = chunksize)
+
+class RefinedWriter:
+    """
+    This class writes refined data in one of OUTPUT_FORMATS a chunk at a time, without the index. Writing goes through
+    pyarrow, which converts columns on several threads and compresses in native code. Without pyarrow, .csv and .csv.gz
+    are written by pandas.
+    """
+    def __init__(self, filepath, fmt = None, append = False):
+        """
+        Constructor for RefinedWriter. The file is opened by the first write.
+
+        Parameters:
+        - filepath (str): filepath to write to.
+        - fmt (str): one of OUTPUT_FORMATS, found from the extension of filepath if not given.
+        - append (bool): if True, add rows to the end of an existing file without a header. Only .csv formats can be appended to.
+        """
+        self.filepath = filepath
+        self.fmt = fmt or output_format(filepath)
+        if self.fmt not in OUTPUT_FORMATS:
+            raise ValueError(f'Unknown output format \'{self.fmt}\', expected one of {list(OUTPUT_FORMATS)}')
+        if append and self.fmt in ['parquet', 'arrow']:
+            raise ValueError(f'Can\'t append to {self.fmt} files')
+        if pa == None and self.fmt not in ['csv', 'csv.gz']:
+            raise ImportError(f'pyarrow is needed to write {self.fmt} files')
+        self.append = append
+        self.n_rows = 0
+        self._schema = None
+        # Schema of an empty chunk, used only if no chunk has rows
+        self._empty_schema = None
+        self._sink = None
+        self._writer = None
+
+    def _open(self, schema):
+        """
+        Opens the file for writing tables with the given schema.
+        """
+        self._schema = schema
+        if self.fmt == 'parquet':
+            self._writer = pq.ParquetWriter(self.filepath, schema, compression = 'zstd')
+        elif self.fmt == 'arrow':
+            # Left uncompressed, so the file can be memory mapped when read
+            self._writer = pa.ipc.new_file(self.filepath, schema)
+        else:
+            self._sink = pa.OSFile(self.filepath, 'ab' if self.append else 'wb')
+            if self.fmt != 'csv':
+                self._sink = pa.CompressedOutputStream(self._sink, 'gzip' if self.fmt == 'csv.gz' else 'zstd')
+            options = pa_csv.WriteOptions(include_header = not self.append, quoting_style = 'needed')
+            self._writer = pa_csv.CSVWriter(self._sink, schema, write_options = options)
+
+    def write(self, df):
+        """
+        Writes a chunk of refined data.
+
+        Parameters:
+        - df (pd.DataFrame): refined data, with the same columns as earlier chunks.
+        """
+        if pa == None:
+            started = self.append or self.n_rows > 0
+            df.to_csv(self.filepath, mode = 'a' if started else 'w', header = not started, index = False,
+                      compression = 'gzip' if self.fmt == 'csv.gz' else None)
+        else:
+            table = pa.Table.from_pandas(df, preserve_index = False)
+            if self._writer == None and len(table) == 0:
+                # Columns of an empty chunk can't be typed, e.g. Region with no values is null, so wait for a chunk with rows
+                self._empty_schema = table.schema
+                return
+            if self._writer == None:
+                self._open(table.schema)
+            else:
+                # Types inferred for a chunk, e.g. int or float, can differ from the first
+                table = table.cast(self._schema)
+            self._writer.write_table(table)
+        self.n_rows += len(df)
+
+    def close(self):
+        """
+        Finishes writing, flushing compressed data and file footers.
+        """
+        if self._writer == None and self._empty_schema != None:
+            # Every chunk was empty, so write a file with no rows
+            self._open(self._empty_schema)
+        if self._writer != None:
+            self._writer.close()
+        if self._sink != None:
+            self._sink.close()
+
+def _parse_variable_list(filepath):
+    """
+    Parses the helper file into a dictionary of the description of each value of each column.
+
+    Parameters:
+    - filepath (str): filepath of 'Teaching_File_Variable_List.xlsx'.
+
+    Returns:
+    dict: description of each value, keyed by column then value as str.
+    """
+    desc_df = pd.read_excel(filepath)
+    desc_df.drop(0, inplace = True)
+    # Names are only given on the first row of each column's values
+    desc_df['Variable Name'] = desc_df['Variable Name'].ffill()
+    desc_df['Variable Name'] = desc_df['Variable Name'].replace({'Student (Schoolchild or full-time student)': 'Student', 'Health (General health)': 'Health'})
+    # Values are given as e.g. '1. Male', split into the value and its description
+    split = desc_df['Variable Values'].str.split('.', n = 1, expand = True)
+    desc_df['Alphanumerical'] = split[0]
+    desc_df['Desc'] = split[1].str.strip()
+    # Values with no description, such as 'Unique reference ID', are kept as None
+    desc_df['Desc'] = desc_df['Desc'].astype(object).where(desc_df['Desc'].notna(), None)
+    return {k: dict(zip(group['Alphanumerical'], group['Desc'])) for k, group in desc_df.groupby('Variable Name', sort = False)}
+
+def load_variable_dict(filepath = VARIABLE_LIST_PATH):
+    """
+    Gets the description of each value of each column. Parsing the helper file is slow, so the result is cached as
+    .json next to it, keyed on a hash of the file, and only parsed again when the file changes.
+
+    Parameters:
+    - filepath (str): filepath of 'Teaching_File_Variable_List.xlsx'.
+
+    Returns:
+    dict: description of each value, keyed by column then value as str.
+    """
+    with open(filepath, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    cache = os.path.splitext(filepath)[0] + '.json'
+    if os.path.exists(cache):
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached.get('sha256') == digest:
+            return cached['variable_dict']
+    variable_dict = _parse_variable_list(filepath)
+    # Cache is only a speed up, so carry on if it can't be written, e.g. read only folder
+    try:
+        with open(cache, 'w') as f:
+            json.dump({'sha256': digest, 'variable_dict': variable_dict}, f, indent = 2)
+    except OSError:
+        pass
+    return variable_dict